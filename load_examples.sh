@@ -11,19 +11,21 @@ else
     qtask init
 fi
 
-echo "\nCreating projects"
-qtask add project Annotation
-qtask add project 'T parva'
-
-echo "\nLogging work"
-qtask log "Group status meeting"
-qtask log "Configured JBrowse instance" to "T parva"
-qtask log "Created script to split isoforms" to "T parva"
-qtask log "Generated latest annotation" to "T parva"
-qtask log "Conference call with S. Smith"
-qtask log "Submitted work summary for the week"
-qtask log "Added EggNOG parsing script" to Annotation
-qtask log "Installated latest version of HMMER" to Annotation
+echo "\nCreating projects and logging work"
+# one qtask process and one connection for the whole set
+qtask batch - <<'EOF'
+add project Annotation
+add project 'T parva'
+
+log "Group status meeting"
+log "Configured JBrowse instance" to "T parva"
+log "Created script to split isoforms" to "T parva"
+log "Generated latest annotation" to "T parva"
+log "Conference call with S. Smith"
+log "Submitted work summary for the week"
+log "Added EggNOG parsing script" to Annotation
+log "Installated latest version of HMMER" to Annotation
+EOF
 
 echo "\nDone.  Now try some of the following commands:"
 echo "  qtask list projects"
@@ -18,75 +18,891 @@ For any time deltas based on a 'year', 365 days are used.
 
 """
 
-import argparse
+# Only what nearly every command needs is imported here.  Everything else is imported where
+# it's used, so a quick 'qtask log' doesn't pay for argparse, the daemon, reports and so on.
+import collections
 import datetime
+import itertools
 import os
 import sqlite3
+import struct
 import sys
+import time
 
-def main():
-    DB_FILE_PATH = "{0}/.qtask.db".format(os.environ['HOME'])
-    
-    parser = argparse.ArgumentParser( description='Command-line task logging, management and reporting')
-    parser.add_argument('-d', '--db_file', type=str, required=False, help='Use an alternative DB file' )
-    parser.add_argument('arglist', metavar='N', type=str, nargs='+', help='All arguments to qtask to here.')
-    args = parser.parse_args()
+# parsing wouldn't work if any of these words were used as a project name
+PROJECT_RESERVED_WORDS = ['work']
+
+# number of rows sent to the database per executemany() call by the import command
+IMPORT_CHUNK_SIZE = 1000
+
+# number of task rows rewritten per statement when a migration backfills a column
+MIGRATION_CHUNK_SIZE = 10000
+
+# Older versions stored dates given to 'log ... on <date>' as typed.  SQLite can't read these,
+# so upgrades try each of these formats on them.
+LEGACY_DATE_FORMATS = ['%m/%d/%Y', '%m/%d/%Y %H:%M', '%m/%d/%Y %H:%M:%S', '%m/%d/%y', '%m-%d-%Y', '%Y/%m/%d',
+                       '%Y/%m/%d %H:%M', '%Y%m%d', '%d %B %Y', '%d %b %Y', '%B %d, %Y', '%b %d, %Y', '%B %d %Y', '%b %d %Y']
+
+# number of rows pulled from the cursor at a time when streaming a report
+REPORT_FETCH_SIZE = 500
+
+# batches of rows each DB file's reader can get ahead of a team report by before it waits
+TEAM_REPORT_QUEUE_SIZE = 4
+
+# how long to wait for another process's write lock, overridden by --busy_timeout or the env var
+DEFAULT_BUSY_TIMEOUT = 10.0
+BUSY_TIMEOUT_ENV_VAR = 'QTASK_BUSY_TIMEOUT'
+
+# if a command still finds the DB busy it's retried this many times, backing off from this many seconds
+BUSY_RETRY_ATTEMPTS = 5
+BUSY_RETRY_DELAY = 0.05
+
+# reported when another writer still has the DB locked after all that
+BUSY_ERROR_MESSAGE = "Qtask: Sorry, the database is busy with another write.  Please try again, or wait longer with --busy_timeout"
+
+# commands which write, and so take the write lock when they start
+WRITE_COMMANDS = ('add', 'import', 'log', 'rebuild-rollups')
+
+# output formats of list and report.  Everything but text is meant for other programs to read.
+OUTPUT_FORMATS = ('text', 'tsv', 'csv', 'jsonl')
+
+# how many matches 'qtask search' shows unless --limit is given
+SEARCH_DEFAULT_LIMIT = 50
+
+# by default a 'qtask batch' session commits after this many commands
+BATCH_COMMIT_INTERVAL = 100
+
+SHELL_PROMPT = 'qtask> '
+
+# 'qtask archive' moves old tasks to one file per year next to the DB, e.g. ~/.qtask.db.archive-2014
+ARCHIVE_FILE_SUFFIX = '.archive-'
+
+# after anything is written, a summary for 'qtask status --fast' is saved next to the DB, e.g. ~/.qtask.db.status
+STATUS_FILE_SUFFIX = '.status'
+
+# rows sampled per index by the ANALYZE in 'qtask maintain', which keeps it quick on any size of DB
+MAINTAIN_ANALYSIS_LIMIT = 1000
+
+# tables whose row counts 'qtask maintain' reports
+MAINTAIN_COUNTED_TABLES = ('project', 'task', 'task_closure', 'task_time', 'daily_project_totals')
+
+# commands whose plain command lines are parsed without argparse (see parse_simple_args())
+SIMPLE_ARGS_COMMANDS = ('add', 'list', 'log', 'report', 'search', 'status')
+
+# options other than --db_file which take a value, which the daemon client needs to skip over
+VALUE_OPTIONS = ('--after', '--busy_timeout', '--commit_interval', '--format', '--limit')
+
+# set to 1 to profile every run as if --profile were given (and to a file name for --profile_dump)
+PROFILE_ENV_VAR = 'QTASK_PROFILE'
+PROFILE_DUMP_ENV_VAR = 'QTASK_PROFILE_DUMP'
+
+# commands a client may hand off to a running 'qtask serve' daemon.  Anything reading STDIN
+# or needing its own connection (init, serve, import) always runs directly.
+DAEMON_COMMANDS = ('add', 'archive', 'list', 'log', 'rebuild-rollups', 'report', 'search')
+
+# daemon tuning: prepared statements kept per connection, page cache size and listen() backlog
+DAEMON_STATEMENT_CACHE_SIZE = 512
+DAEMON_CACHE_KIB = 65536
+DAEMON_LISTEN_BACKLOG = 32
+
+# output is sent back to clients in frames of about this many characters
+DAEMON_OUTPUT_BUFFER_SIZE = 65536
+
+# daemon messages are a one byte type and a payload length, followed by the payload
+DAEMON_FRAME_HEADER = struct.Struct('>cI')
 
-    if args.db_file is not None:
-        DB_FILE_PATH = args.db_file
+# the start of time as far as time_added_epoch is concerned
+EPOCH_START = datetime.datetime(1970, 1, 1)
+
+def main():
+    main_started = time.perf_counter()
+    argv = sys.argv[1:]
+
+    # if a 'qtask serve' daemon is running for this DB let it do the work
+    status = forward_to_daemon(argv)
+    if status is not None:
+        sys.exit(status)
+
+    # the everyday commands skip building the argparse parser unless they use other options
+    parser = None
+    args = parse_simple_args(argv)
+    if args is None:
+        parser = build_arg_parser()
+        args = parser.parse_args(argv)
+
+    connect_args = {'timeout': get_busy_timeout(args)}
     
     command = args.arglist[0]
+    profile = None
+    conn = None
+    status_summary = None
+
+    if is_profiling(args):
+        profile = CommandProfile(main_started, args.profile_dump or os.environ.get(PROFILE_DUMP_ENV_VAR))
+        profile.mark('parse arguments')
+        connect_args['factory'] = ProfilingConnection
     
-    if command == 'init':
-        initialize_db(DB_FILE_PATH)
+    try:
+        db_file_paths = get_db_file_paths(args.db_file)
+        DB_FILE_PATH = db_file_paths[0]
 
-    else:
-        conn = sqlite3.connect(DB_FILE_PATH)
-        curs = conn.cursor()
+        if len(db_file_paths) > 1 and command != 'report':
+            print_error("Qtask: Sorry, only report can be run on more than one DB file at a time")
 
-        if command == 'add':
-            if len(args.arglist) != 3:
-                print_error("Usage: qtask add project <foo>")
-            else:
-                process_add_command(curs, args.arglist[1], args.arglist[2])
+        # 'status --fast' doesn't open the DB at all if the summary saved by the last write is current
+        saved_status = None
+        if command == 'status' and args.fast:
+            saved_status = read_status_file(DB_FILE_PATH)
+
+        if command == 'init':
+            initialize_db(DB_FILE_PATH)
 
         elif command == 'help':
-            if len(args.arglist) == 1:
-                print("Qtask help:  Get help by passing any command name 'add', 'log', 'list', or 'init'.  For example:\n\n" \
-                      "\tqtask help add\n")
-            elif len(args.arglist) == 2:
-                print_help_for_command(args.arglist[1])
-            else:
-                print_error("Usage: qtask help <somecommand>")
+            # help doesn't need the database, which may not even exist yet
+            run_command(None, args)
 
-        elif command == 'list' or command == 'report':
-            if len(args.arglist) < 2:
-                print_error("Usage: qtask list <description>.  Please see help for more examples")
+        elif command == 'serve':
+            serve_db(DB_FILE_PATH, timeout=get_busy_timeout(args))
+
+        elif len(db_file_paths) > 1:
+            process_team_report_command(db_file_paths, args.arglist, output_format=args.format, limit=args.limit, after=args.after)
+
+        elif saved_status is not None:
+            print_status(saved_status, output_format=args.format)
+
+        else:
+            store = TaskStore.open(DB_FILE_PATH, **connect_args)
+            conn = store.conn
+            curs = store.curs
+            changes_before = conn.total_changes
+
+            if profile is not None:
+                profile.mark('connect + schema check')
+                profile.start_command(conn)
+
+            if command == 'batch' or command == 'shell':
+                status = process_batch_command(store, args.arglist, parser, commit_interval=args.commit_interval)
+                store.commit()
+            elif command == 'status':
+                # kept before it's printed, so it's still saved if the output is cut short (e.g. by head)
+                status_summary = get_status(curs)
+                process_status_command(curs, args.arglist, output_format=args.format, status=status_summary)
+                status = 0
             else:
-                process_list_command(curs, args.arglist)
-                
-        elif command == 'log':
-            if len(args.arglist) < 2:
-                print_error("Usage: qtask log <description>.  Please see help for more examples")
+                run_command_with_retry(store, args)
+                status = 0
+
+            if conn.total_changes != changes_before:
+                status_summary = get_status(curs)
+
+            curs.close()
+
+            if status != 0:
+                sys.exit(status)
+
+    except QtaskError as e:
+        print(e)
+        sys.exit(1)
+
+    except sqlite3.OperationalError as e:
+        # e.g. a batch or an upgrade which couldn't get the write lock within the busy timeout
+        if not is_busy_error(e):
+            raise
+
+        print(BUSY_ERROR_MESSAGE)
+        sys.exit(1)
+
+    finally:
+        if profile is not None:
+            profile.finish(conn)
+
+        # Saved once the connection is closed, as closing can checkpoint the write-ahead log
+        # into the DB file, which would otherwise make the summary look out of date at once.
+        if status_summary is not None:
+            conn.close()
+            write_status_file(DB_FILE_PATH, status_summary)
+
+
+class QtaskError(Exception):
+    """
+    A user-facing error which ends the current command (see print_error())
+    """
+    pass
+
+
+# one task as yielded by TaskStore.iter_tasks().  time_added is a datetime and time_logged is in minutes.
+TaskRow = collections.namedtuple('TaskRow', ['id', 'parent_id', 'project_id', 'project', 'label', 'time_added', 'time_logged'])
+
+
+class TaskStore(object):
+    """
+    Python interface to a qtask database, for scripts which would otherwise run the qtask
+    command, and what the commands themselves are built on.  It wraps one connection:
+
+        store = qtask.TaskStore.open(os.path.expanduser('~/.qtask.db'))
+
+        with store.batch():
+            task_id = store.log_task('Ran the aligner', project='Annotation')
+            store.add_time(task_id, 90)
+
+        for task in store.iter_tasks(project='Annotation', since=datetime.date(2015, 1, 1)):
+            print(task.id, task.time_added, task.label)
+
+    Each write is committed on its own unless a transaction is already open, such as one from
+    batch().  Mistakes like an unknown project raise QtaskError.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.curs = conn.cursor()
+
+        # project label -> id.  Projects are never renamed or deleted, so entries only go
+        # stale if the project's insert is rolled back (see rollback()).
+        self.project_ids = dict()
+
+    @classmethod
+    def open(cls, file_path, **connect_args):
+        return cls(connect_db(file_path, **connect_args))
+
+    def batch(self):
+        """
+        Returns a context manager running everything inside it as one transaction, committed
+        at the end or rolled back if it raises.  Within an open transaction it does nothing.
+        """
+        return TaskStoreBatch(self)
+
+    def commit(self):
+        self.conn.commit()
+
+    def rollback(self):
+        self.conn.rollback()
+        self.project_ids.clear()
+
+    def close(self):
+        self.curs.close()
+        self.conn.close()
+
+    def get_project_id(self, label):
+        """
+        Returns the ID of the project with this label, or None if there isn't one
+        """
+        if label not in self.project_ids:
+            self.curs.execute('''SELECT id FROM project WHERE label=?''', (label,) )
+            row = self.curs.fetchone()
+
+            if row is None:
+                return None
+
+            self.project_ids[label] = row[0]
+
+        return self.project_ids[label]
+
+    def add_project(self, label):
+        if label in PROJECT_RESERVED_WORDS:
+            print_error("Qtask: Sorry, the word '{0}' is reserved and can't be used for a project name.".format(label))
+
+        if self.get_project_id(label) is not None:
+            print_error("Qtask: Sorry, a project called '{0}' already exists.".format(label))
+
+        with self.batch():
+            self.curs.execute("INSERT INTO project (label, time_added) VALUES (?, ?)", (label, "{0}".format(datetime.datetime.now())) )
+            self.project_ids[label] = self.curs.lastrowid
+
+        return self.project_ids[label]
+
+    def log_task(self, label, project=None, parent_id=None, time_added=None):
+        """
+        Logs a task and returns its ID.  Subtasks (those given a parent_id) are filed to the same
+        project as their parent.  time_added defaults to now, and may be a date, a datetime or
+        a string like '2015-01-21' or '2015-01-21 14:30'.
+        """
+        if time_added is None:
+            time_added = datetime.datetime.now()
+
+        time_added_epoch = get_user_date_epoch(time_added)
+        project_id = None
+
+        if parent_id is not None:
+            if project is not None:
+                print_error("Qtask: Sorry, subtasks are always filed to the same project as their parent")
+
+            parent_id = get_task_id(self.curs, parent_id)
+            self.curs.execute('''SELECT project_id FROM task WHERE id = ?''', (parent_id,) )
+            project_id = self.curs.fetchone()[0]
+
+        elif project is not None:
+            project_id = self.get_project_id(project)
+
+            if project_id is None:
+                print_error("Qtask: ERROR: couldn't find project '{0}' to log work against".format(project))
+
+        with self.batch():
+            self.curs.execute("INSERT INTO task (parent_id, label, time_added, time_added_epoch, project_id) VALUES (?, ?, ?, ?, ?)",
+                              (parent_id, label, "{0}".format(time_added), time_added_epoch, project_id) )
+
+        return self.curs.lastrowid
+
+    def add_time(self, task_id, minutes):
+        """
+        Adds minutes to the time logged against a task
+        """
+        with self.batch():
+            # increment it in a single statement so concurrent increments can't overwrite each other
+            self.curs.execute('''UPDATE task SET time_logged = COALESCE(time_logged, 0) + ? WHERE id = ?''', (minutes, task_id))
+
+            if self.curs.rowcount == 0:
+                print_error("Sorry, couldn't find a task with ID={0}".format(task_id))
+
+    def iter_tasks(self, project=None, since=None, until=None):
+        """
+        Generator of TaskRow tuples for the work logged, most recent first, optionally only that
+        in one project (by label) or added from since (inclusive) until (exclusive).  Dates may
+        be given as for log_task().  Archived work is included.
+        """
+        from_date = None if since is None else get_user_date_epoch(since)
+        until_date = None if until is None else get_user_date_epoch(until)
+
+        # a cursor of its own, so the caller can write to the store while iterating
+        curs = self.conn.cursor()
+        qry_args = list()
+        qry_str = '''
+        SELECT COALESCE(p.label, 'Other (no project)'), t.time_added_epoch, t.id,
+               t.id, t.parent_id, t.project_id, p.label, t.label, t.time_added_epoch, t.time_logged
+          FROM {tasks} t
+               LEFT JOIN {projects} p ON t.project_id=p.id
+        '''
+
+        if project is not None:
+            project_id = self.get_project_id(project)
+            if project_id is None:
+                print_error("Qtask: Couldn't find project '{0}'".format(project))
+
+            qry_str += " WHERE t.project_id = ? "
+            qry_args.append(project_id)
+
+        if from_date is not None:
+            qry_str += " AND " if 'WHERE' in qry_str else " WHERE "
+            qry_str += " t.time_added_epoch >= ? "
+            qry_args.append(from_date)
+
+        if until_date is not None:
+            qry_str += " AND " if 'WHERE' in qry_str else " WHERE "
+            qry_str += " t.time_added_epoch < ? "
+            qry_args.append(until_date)
+
+        qry_str += " ORDER BY t.time_added_epoch DESC, t.id DESC "
+
+        try:
+            rows = iter_task_query(curs, qry_str, qry_args, get_archive_years(curs, from_date, until_date))
+
+            for (task_id, parent_id, project_id, project_label, label, time_added_epoch, time_logged) in (row[3:] for row in rows):
+                time_added = None if time_added_epoch is None else EPOCH_START + datetime.timedelta(seconds=time_added_epoch)
+                yield TaskRow(task_id, parent_id, project_id, project_label, label, time_added, time_logged)
+        finally:
+            curs.close()
+
+
+class TaskStoreBatch(object):
+    """
+    The transaction context manager returned by TaskStore.batch()
+    """
+    def __init__(self, store):
+        self.store = store
+        self.owns_transaction = False
+
+    def __enter__(self):
+        if not self.store.conn.in_transaction:
+            self.store.curs.execute("BEGIN IMMEDIATE")
+            self.owns_transaction = True
+
+        return self.store
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.owns_transaction:
+            self.owns_transaction = False
+
+            if exc_type is None:
+                self.store.commit()
             else:
-                process_log_command(curs, args.arglist)
+                self.store.rollback()
+
+        return False
+
+
+def build_arg_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser( description='Command-line task logging, management and reporting')
+    parser.add_argument('-d', '--db_file', type=str, action='append', required=False,
+                        help='Use an alternative DB file.  Report: give it more than once, or as a directory or glob, to report on several' )
+    parser.add_argument('--create_projects', action='store_true', help='Import: create any projects not yet in the DB' )
+    parser.add_argument('--busy_timeout', type=float, required=False,
+                        help='Seconds to wait on a DB locked by another writer (default ${0} or {1})'.format(
+                            BUSY_TIMEOUT_ENV_VAR, DEFAULT_BUSY_TIMEOUT) )
+    parser.add_argument('--commit_interval', type=int, required=False,
+                        help='Batch/shell: commit after this many commands (default {0} for batch, 1 for shell)'.format(BATCH_COMMIT_INTERVAL) )
+    parser.add_argument('--format', type=str, choices=OUTPUT_FORMATS, default='text',
+                        help='List/report/search: output format, for reading by other programs' )
+    parser.add_argument('--limit', type=int, required=False, help='List/search: the maximum number of results to show' )
+    parser.add_argument('--after', type=str, required=False, help='List: continue from this cursor, printed at the end of the previous page' )
+    parser.add_argument('--fast', action='store_true', help='Status: read the saved summary rather than the DB when it\'s current')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print per-phase timings and every SQL statement with its query plan to STDERR' )
+    parser.add_argument('--profile_dump', type=str, required=False, help='With --profile, also write cProfile stats to this file' )
+    parser.add_argument('arglist', metavar='N', type=str, nargs='+', help='All arguments to qtask to here.')
+    return parser
+
+
+def parse_simple_args(argv):
+    """
+    Parses a command line which gives no options other than --db_file (and --fast) for one of
+    the SIMPLE_ARGS_COMMANDS, returning None for anything else, which is left to argparse.
+    """
+    db_files = list()
+    fast = '--fast' in argv
+    argv_iter = iter([arg for arg in argv if arg != '--fast'])
+
+    for arg in argv_iter:
+        if arg in ('-d', '--db_file'):
+            db_file = next(argv_iter, None)
+            if db_file is None:
+                return None
+
+            db_files.append(db_file)
+        elif arg.startswith('-'):
+            return None
+        else:
+            arglist = [arg] + list(argv_iter)
+            if arglist[0] not in SIMPLE_ARGS_COMMANDS or any(arg.startswith('-') for arg in arglist):
+                return None
+
+            return SimpleArgs(db_files or None, arglist, fast)
+
+    return None
+
+
+class SimpleArgs(object):
+    """
+    Stands in for argparse's Namespace when parse_simple_args() handles the command line.  The
+    option defaults here must match those in build_arg_parser().
+    """
+    create_projects = False
+    busy_timeout = None
+    commit_interval = None
+    format = 'text'
+    limit = None
+    after = None
+    profile = False
+    profile_dump = None
+
+    def __init__(self, db_file, arglist, fast=False):
+        self.db_file = db_file
+        self.arglist = arglist
+        self.fast = fast
+
+
+def run_command_with_retry(store, args):
+    """
+    Runs and commits one command.  Writes take the database's write lock up front (waiting out
+    other writers via the busy timeout), and if SQLite still reports the database as busy or
+    locked the whole command is rolled back and retried with an increasing, jittered delay.
+    """
+    command = args.arglist[0]
+
+    for attempt in range(1, BUSY_RETRY_ATTEMPTS + 1):
+        try:
+            if command in WRITE_COMMANDS and not store.conn.in_transaction:
+                store.curs.execute("BEGIN IMMEDIATE")
+
+            run_command(store, args)
+            store.commit()
+            return
+
+        except sqlite3.OperationalError as e:
+            store.rollback()
+            if not is_busy_error(e):
+                raise
 
+            if attempt == BUSY_RETRY_ATTEMPTS:
+                print_error(BUSY_ERROR_MESSAGE)
+
+            import random
+            time.sleep(BUSY_RETRY_DELAY * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5))
+
+        except BaseException:
+            store.rollback()
+            raise
+
+
+def is_busy_error(e):
+    """
+    Tells whether an SQLite error is because another connection has the database locked
+    """
+    message = str(e)
+    return isinstance(e, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def run_command(store, args):
+    """
+    Dispatches one parsed qtask command against an open TaskStore (None for help).  Committing
+    is left to the caller.
+    """
+    # the process_* functions consume their argument lists, so work on a copy in case of a retry
+    arglist = list(args.arglist)
+    command = arglist[0]
+    curs = None if store is None else store.curs
+
+    if command == 'add':
+        if len(arglist) != 3:
+            print_error("Usage: qtask add project <foo>")
         else:
-            raise Exception("ERROR: Unrecognized qtask command: {0}".format(command))
+            process_add_command(store, arglist[1], arglist[2])
 
-        conn.commit()
-        curs.close()
+    elif command == 'archive':
+        process_archive_command(curs, arglist)
 
+    elif command == 'import':
+        if len(arglist) > 2:
+            print_error("Usage: qtask import <file.csv|file.jsonl|->")
+        else:
+            process_import_command(store, arglist, create_projects=args.create_projects)
+
+    elif command == 'help':
+        if len(arglist) == 1:
+            print("Qtask help:  Get help by passing any command name 'add', 'archive', 'batch', 'import', 'log', 'list', 'maintain', 'search', 'serve', 'shell', 'status', 'sync', or 'init'.  For example:\n\n" \
+                  "\tqtask help add\n")
+        elif len(arglist) == 2:
+            print_help_for_command(arglist[1])
+        else:
+            print_error("Usage: qtask help <somecommand>")
+
+    elif command == 'list' or command == 'report':
+        if len(arglist) < 2:
+            print_error("Usage: qtask list <description>.  Please see help for more examples")
+        else:
+            process_list_command(store, arglist, output_format=args.format, limit=args.limit, after=args.after)
+            
+    elif command == 'search':
+        process_search_command(store, arglist, output_format=args.format, limit=args.limit)
+
+    elif command == 'sync':
+        process_sync_command(curs, arglist, timeout=get_busy_timeout(args))
+
+    elif command == 'maintain':
+        process_maintain_command(curs, arglist)
+
+    elif command == 'status':
+        process_status_command(curs, arglist, output_format=args.format)
+
+    elif command == 'rebuild-rollups':
+        rebuild_rollups(curs)
+        print("Qtask: time rollups rebuilt from the task table")
+
+    elif command == 'log':
+        if len(arglist) < 2:
+            print_error("Usage: qtask log <description>.  Please see help for more examples")
+        else:
+            process_log_command(store, arglist)
 
-def get_project_id_by_label(curs, label):
-    curs.execute('''SELECT id FROM project WHERE label=?''', (label,) )
-    row = curs.fetchone()
-        
-    if row:
-        return row[0]
     else:
+        print_error("Qtask: Unrecognized qtask command: {0}.  Try 'qtask help'".format(command))
+
+
+def connect_db(file_path, **connect_args):
+    """
+    Opens the database, upgrading its schema first if it was created by an older
+    version of qtask.  Any keyword arguments are passed on to sqlite3.connect().
+    """
+    if not os.path.exists(file_path):
+        print_error("Qtask: the db file ({0}) doesn't exist yet.  Please run 'qtask init' first.".format(file_path))
+
+    conn = sqlite3.connect(file_path, **connect_args)
+    upgrade_db(conn)
+    return conn
+
+
+def forward_to_daemon(argv):
+    """
+    Sends a command line to a running 'qtask serve' daemon and relays its output.  Returns the
+    command's exit status, or None if the command should be run directly instead, either because
+    it can't be served remotely or because no daemon is listening.
+    """
+    db_file = None
+    command = None
+    argv_iter = iter(argv)
+
+    # profiling is of the direct code path, so never hand those runs off
+    if os.environ.get(PROFILE_ENV_VAR, '0') != '0':
         return None
 
+    # a minimal scan of the arguments, since building the full argparse parser is what we're avoiding
+    for arg in argv_iter:
+        option = arg.split('=', 1)[0]
+
+        # every way argparse takes --db_file: -d x, -dx, -d=x, --db_file x, --db_file=x and
+        # abbreviations such as --db=x
+        if arg.startswith('-d') or (len(option) > 2 and '--db_file'.startswith(option)):
+            # several DB files are only ever read together, directly
+            if db_file is not None:
+                return None
+
+            if arg == '-d' or (arg.startswith('--') and '=' not in arg):
+                db_file = next(argv_iter, None)
+            elif arg.startswith('--'):
+                db_file = arg.split('=', 1)[1]
+            else:
+                db_file = arg[3:] if arg.startswith('-d=') else arg[2:]
+
+            if db_file is None:
+                return None
+        elif arg in VALUE_OPTIONS:
+            next(argv_iter, None)
+        elif arg in ('-h', '--help', '--profile', '--profile_dump') or arg.startswith('--profile_dump='):
+            return None
+        elif not arg.startswith('-'):
+            command = arg
+            break
+
+    if command not in DAEMON_COMMANDS:
+        return None
+
+    # only pay for the socket module when there's a daemon's socket to connect to
+    socket_path = get_daemon_socket_path(get_db_file_path(db_file))
+    if not os.path.exists(socket_path):
+        return None
+
+    import json
+    import socket
+
+    try:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(socket_path)
+    except OSError:
+        return None
+
+    try:
+        request = json.dumps({'argv': argv, 'cwd': os.getcwd()}).encode('utf-8')
+        sock.sendall(DAEMON_FRAME_HEADER.pack(b'r', len(request)) + request)
+        reader = sock.makefile('rb')
+
+        while True:
+            header = reader.read(DAEMON_FRAME_HEADER.size)
+            if len(header) < DAEMON_FRAME_HEADER.size:
+                print("Qtask: ERROR: lost connection to the qtask daemon", file=sys.stderr)
+                return 1
+
+            (frame_type, length) = DAEMON_FRAME_HEADER.unpack(header)
+            payload = reader.read(length)
+
+            if frame_type == b'o':
+                sys.stdout.write(payload.decode('utf-8'))
+            elif frame_type == b'e':
+                sys.stderr.write(payload.decode('utf-8'))
+            elif frame_type == b'x':
+                sys.stdout.flush()
+                return int(payload)
+            elif frame_type == b'd':
+                # the command line is for another DB than the daemon's, so run it here
+                return None
+    finally:
+        sock.close()
+
+
+def get_daemon_socket_path(db_file_path):
+    return "{0}.sock".format(os.path.abspath(db_file_path))
+
+
+def get_archive_path(db_file_path, year):
+    return "{0}{1}{2:d}".format(db_file_path, ARCHIVE_FILE_SUFFIX, year)
+
+
+def get_status_file_path(db_file_path):
+    return "{0}{1}".format(db_file_path, STATUS_FILE_SUFFIX)
+
+
+def get_archive_years(curs, from_date=None, until=None):
+    """
+    Returns the years which have an archive file next to the connected DB, limited to those
+    overlapping the epoch range [from_date, until) if one is given.
+    """
+    (db_dir, db_file_name) = os.path.split(get_connected_db_path(curs))
+    prefix = db_file_name + ARCHIVE_FILE_SUFFIX
+    years = list()
+
+    for file_name in os.listdir(db_dir):
+        year = file_name[len(prefix):]
+        if not file_name.startswith(prefix) or not year.isdigit():
+            continue
+
+        (year_start, year_end) = get_year_range(int(year))
+        if (from_date is None or from_date < year_end) and (until is None or until > year_start):
+            years.append(int(year))
+
+    return sorted(years)
+
+
+def get_busy_timeout(args):
+    if args.busy_timeout is not None:
+        return args.busy_timeout
+
+    if os.environ.get(BUSY_TIMEOUT_ENV_VAR):
+        try:
+            return float(os.environ[BUSY_TIMEOUT_ENV_VAR])
+        except ValueError:
+            print_error("Qtask: ERROR: ${0} must be a number of seconds".format(BUSY_TIMEOUT_ENV_VAR))
+
+    return DEFAULT_BUSY_TIMEOUT
+
+
+def get_connected_db_path(curs):
+    curs.execute("PRAGMA database_list")
+    return [file_path for (seq, name, file_path) in curs.fetchall() if name == 'main'][0]
+
+
+def get_date_range(args):
+    """
+    Parses the chronological part of a list/report description into an (inclusive, exclusive)
+    pair of epoch seconds.  Supported forms:
+
+    today
+    yesterday
+    in last <N> <days|weeks|years>
+    between <date> and <date>
+    """
+    today = datetime.date.today()
+
+    if len(args) == 1 and args[0] == 'today':
+        return (get_epoch(today), get_epoch(today + datetime.timedelta(days=1)))
+
+    elif len(args) == 1 and args[0] == 'yesterday':
+        return (get_epoch(today - get_delta(1, 'day')), get_epoch(today))
+
+    elif len(args) == 4 and args[0] == 'in' and args[1] == 'last':
+        try:
+            delta = get_delta(int(args[2]), args[3])
+        except ValueError:
+            delta = None
+
+        if delta is not None:
+            now = datetime.datetime.now()
+            return (get_epoch(now - delta), get_epoch(now) + 1)
+
+    elif len(args) == 4 and args[0] == 'between' and args[2] == 'and':
+        from_date = get_user_date_epoch(args[1])
+        until_date = get_user_date_epoch(args[3])
+
+        # a bare end date covers that whole day
+        if len(args[3].strip()) == 10:
+            until_date += 86400
+        else:
+            until_date += 1
+
+        return (from_date, until_date)
+
+    print_error("Qtask: Sorry, I couldn't recognize your list syntax. Please see the examples and try again")
+
+
+def get_db_file_path(db_file=None):
+    if db_file is not None:
+        return db_file
+
+    return "{0}/.qtask.db".format(os.environ['HOME'])
+
+
+def get_db_file_paths(db_files=None):
+    """
+    Expands the --db_file values given, any of which may be a directory (meaning every *.db
+    file in it) or a glob pattern, into a list of DB file paths.
+    """
+    if not db_files:
+        return [get_db_file_path()]
+
+    file_paths = list()
+
+    for db_file in db_files:
+        if os.path.isdir(db_file) or any(c in db_file for c in '*?['):
+            import glob
+
+            if os.path.isdir(db_file):
+                matches = sorted(glob.glob(os.path.join(glob.escape(db_file), '*.db')))
+            else:
+                matches = sorted(glob.glob(db_file))
+        else:
+            matches = [db_file]
+
+        if not matches:
+            print_error("Qtask: Sorry, no DB files were found at {0}".format(db_file))
+
+        file_paths.extend(matches)
+
+    return file_paths
+
+
+def get_epoch(value):
+    """
+    Converts a datetime or the date/time strings stored in task.time_added to integer
+    seconds since 1970-01-01, treating the time as-is (no time zone conversion), which
+    matches SQLite's strftime('%s', ...).  Returns None if the value can't be parsed.
+    """
+    if isinstance(value, str):
+        try:
+            value = datetime.datetime.fromisoformat(value.strip())
+        except ValueError:
+            return None
+    elif isinstance(value, datetime.date) and not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+
+    # the same as calendar.timegm(value.timetuple()), without importing calendar
+    return (value.replace(microsecond=0, tzinfo=None) - EPOCH_START) // datetime.timedelta(seconds=1)
+
+
+def get_task_id(curs, value):
+    """
+    Checks that a task ID given by the user exists and returns it as an int
+    """
+    try:
+        task_id = int(value)
+    except ValueError:
+        print_error("Qtask: Sorry, '{0}' isn't a valid task ID".format(value))
+
+    curs.execute('''SELECT id FROM task WHERE id = ?''', (task_id,) )
+    if curs.fetchone() is None:
+        print_error("Sorry, couldn't find a task with ID={0}".format(task_id))
+
+    return task_id
+
+
+def get_user_date_epoch(value):
+    epoch = get_epoch(value)
+
+    if epoch is None:
+        print_error("Qtask: Sorry, I couldn't understand the date '{0}'.  Please use a format like 2015-01-21 " \
+                    "or '2015-01-21 14:30'".format(value))
+
+    return epoch
+
+
+def is_profiling(args):
+    if args.profile or args.profile_dump is not None:
+        return True
+
+    return os.environ.get(PROFILE_ENV_VAR, '0') != '0' or bool(os.environ.get(PROFILE_DUMP_ENV_VAR))
+
+
+def get_page_cursor(time_added_epoch, task_id):
+    return "{0}:{1}".format(time_added_epoch, task_id)
+
+
+def get_read_only_uri(file_path):
+    uri_path = os.path.abspath(file_path).replace('%', '%25').replace('?', '%3f').replace('#', '%23')
+    return "file:{0}?mode=ro".format(uri_path)
+
+
+def get_year_range(year):
+    """
+    Returns the epoch range [start, end) of a calendar year
+    """
+    return (get_epoch(datetime.date(year, 1, 1)), get_epoch(datetime.date(year + 1, 1, 1)))
+
 
 def initialize_db(file_path):
     # First, check to see if the file exists already.
@@ -100,6 +916,10 @@ def initialize_db(file_path):
     conn = sqlite3.connect(file_path)
     curs = conn.cursor()
 
+    # lets 'qtask maintain' hand back space freed by deleted rows.  It has to be set before any
+    # tables are created.
+    curs.execute("PRAGMA auto_vacuum = INCREMENTAL")
+
     curs.execute("""
               CREATE TABLE project (
                  id                integer primary key autoincrement,
@@ -126,71 +946,777 @@ def initialize_db(file_path):
     conn.commit()
     curs.close()
 
-def list_tasks(curs, project_id=None, from_date=None, until=None, group_by=None):
+    # everything after the original schema is applied as a migration
+    upgrade_db(conn, verbose=False)
+
+
+def migrate_add_time_added_epoch(curs):
+    # the text column holds a mix of formats, so keep a normalized integer copy for range scans
+    curs.execute("PRAGMA table_info(task)")
+    if 'time_added_epoch' not in [row[1] for row in curs.fetchall()]:
+        curs.execute("ALTER TABLE task ADD COLUMN time_added_epoch integer")
+
+    # backfill in chunks of ids so no one statement has to take on a large history at once
+    curs.execute("SELECT MIN(id), MAX(id) FROM task WHERE time_added_epoch IS NULL")
+    (min_id, max_id) = curs.fetchone()
+
+    if min_id is not None:
+        for chunk_start in range(min_id, max_id + 1, MIGRATION_CHUNK_SIZE):
+            curs.execute('''UPDATE task SET time_added_epoch = CAST(strftime('%s', time_added) AS INTEGER)
+                             WHERE id >= ? AND id < ? AND time_added_epoch IS NULL''',
+                         (chunk_start, chunk_start + MIGRATION_CHUNK_SIZE))
+
+    backfill_legacy_time_added_epochs(curs)
+
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_task_time_added_epoch ON task (time_added_epoch)")
+    curs.execute("DROP INDEX IF EXISTS idx_task_time_added")
+
+
+def backfill_legacy_time_added_epochs(curs):
+    """
+    Fills in time_added_epoch for tasks whose time_added SQLite couldn't read, such as the
+    '1/22/2015' older versions stored as typed, by trying LEGACY_DATE_FORMATS.  A task whose
+    date can't be read at all gets the time of the task logged before it (or else after it),
+    so it doesn't drop out of date ranges, totals and paging, and is reported.
+    """
+    curs.execute("SELECT id, time_added FROM task WHERE time_added_epoch IS NULL ORDER BY id")
+    rows = curs.fetchall()
+    guessed_ids = list()
+
+    for (task_id, time_added) in rows:
+        epoch = get_legacy_date_epoch(time_added)
+
+        if epoch is None:
+            guessed_ids.append(task_id)
+            curs.execute('''SELECT COALESCE(
+                                (SELECT time_added_epoch FROM task WHERE id < ? AND time_added_epoch IS NOT NULL ORDER BY id DESC LIMIT 1),
+                                (SELECT time_added_epoch FROM task WHERE id > ? AND time_added_epoch IS NOT NULL ORDER BY id LIMIT 1))''',
+                         (task_id, task_id))
+            epoch = curs.fetchone()[0]
+
+            if epoch is None:
+                epoch = get_epoch(datetime.datetime.now())
+
+        curs.execute('''UPDATE task SET time_added_epoch = ? WHERE id = ?''', (epoch, task_id))
+
+    if guessed_ids:
+        print("Qtask: WARNING: couldn't read the date logged for {0} tasks, so they were dated like the task before " \
+              "them: {1}".format(len(guessed_ids), ", ".join([str(task_id) for task_id in guessed_ids])), file=sys.stderr)
+
+
+def get_legacy_date_epoch(value):
+    if not isinstance(value, str):
+        return None
+
+    epoch = get_epoch(value)
+
+    for date_format in LEGACY_DATE_FORMATS:
+        if epoch is not None:
+            break
+        try:
+            epoch = get_epoch(datetime.datetime.strptime(value.strip(), date_format))
+        except ValueError:
+            pass
+
+    return epoch
+
+
+def migrate_repair_legacy_dates(curs):
+    # databases upgraded by earlier versions may have been left with some tasks' epochs unset
+    backfill_legacy_time_added_epochs(curs)
+
+
+def migrate_add_lookup_indexes(curs):
+    # project labels are looked up on nearly every command, so they need an index.  They should
+    # also be unique, but older databases may already hold duplicates which we won't guess how to merge.
+    curs.execute("SELECT label FROM project GROUP BY label HAVING COUNT(*) > 1")
+    duplicates = [row[0] for row in curs.fetchall()]
+
+    if duplicates:
+        print("Qtask: WARNING: these project labels are used more than once, so they can't be made unique: {0}".format(
+            ", ".join(duplicates)), file=sys.stderr)
+        curs.execute("CREATE INDEX IF NOT EXISTS idx_project_label ON project (label)")
+    else:
+        curs.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_project_label ON project (label)")
+
+    # serves per-project listings in date order without touching other projects' tasks
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_task_project_time_added_epoch ON task (project_id, time_added_epoch)")
+
+
+def migrate_add_daily_rollups(curs):
+    # Per-day, per-project totals so time reports don't need to re-read every task.  Tasks without
+    # a project are kept under project_id 0.  The triggers keep it current for every write path.
+    curs.execute("""
+              CREATE TABLE IF NOT EXISTS daily_project_totals (
+                 day               integer not null,
+                 project_id        integer not null,
+                 task_count        integer not null,
+                 minutes           real not null,
+                 PRIMARY KEY (day, project_id)
+              ) WITHOUT ROWID
+    """)
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_rollup_insert AFTER INSERT ON task
+              WHEN NEW.time_added_epoch IS NOT NULL
+              BEGIN
+                 INSERT INTO daily_project_totals (day, project_id, task_count, minutes)
+                      VALUES (NEW.time_added_epoch / 86400, COALESCE(NEW.project_id, 0), 1, COALESCE(NEW.time_logged, 0))
+                 ON CONFLICT (day, project_id) DO UPDATE
+                      SET task_count = task_count + 1, minutes = minutes + excluded.minutes;
+              END
+    """)
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_rollup_delete AFTER DELETE ON task
+              WHEN OLD.time_added_epoch IS NOT NULL
+              BEGIN
+                 UPDATE daily_project_totals
+                    SET task_count = task_count - 1, minutes = minutes - COALESCE(OLD.time_logged, 0)
+                  WHERE day = OLD.time_added_epoch / 86400 AND project_id = COALESCE(OLD.project_id, 0);
+                 DELETE FROM daily_project_totals
+                  WHERE day = OLD.time_added_epoch / 86400 AND project_id = COALESCE(OLD.project_id, 0) AND task_count <= 0;
+              END
+    """)
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_rollup_update AFTER UPDATE OF time_logged, time_added_epoch, project_id ON task
+              BEGIN
+                 UPDATE daily_project_totals
+                    SET task_count = task_count - 1, minutes = minutes - COALESCE(OLD.time_logged, 0)
+                  WHERE OLD.time_added_epoch IS NOT NULL
+                        AND day = OLD.time_added_epoch / 86400 AND project_id = COALESCE(OLD.project_id, 0);
+                 DELETE FROM daily_project_totals
+                  WHERE OLD.time_added_epoch IS NOT NULL
+                        AND day = OLD.time_added_epoch / 86400 AND project_id = COALESCE(OLD.project_id, 0) AND task_count <= 0;
+                 INSERT INTO daily_project_totals (day, project_id, task_count, minutes)
+                      SELECT NEW.time_added_epoch / 86400, COALESCE(NEW.project_id, 0), 1, COALESCE(NEW.time_logged, 0)
+                       WHERE NEW.time_added_epoch IS NOT NULL
+                 ON CONFLICT (day, project_id) DO UPDATE
+                      SET task_count = task_count + 1, minutes = minutes + excluded.minutes;
+              END
+    """)
+
+    rebuild_rollups(curs)
+
+
+def migrate_enable_wal(curs):
+    # Write-ahead logging lets readers carry on while someone logs work, and writers only block
+    # each other for the length of a commit.  This setting is stored in the DB file itself.
+    # It can't be changed inside a transaction, so the upgrade's lock is let go of meanwhile.
+    # Switching again is harmless if another process gets to it first.
+    curs.connection.commit()
+    curs.execute("PRAGMA journal_mode = WAL")
+    curs.execute("BEGIN IMMEDIATE")
+
+
+def migrate_add_label_search(curs):
+    # Full-text index over task labels for 'qtask search'.  It's an external content table, so
+    # labels aren't stored twice, kept in sync by triggers.  Prefix indexes speed up 'foo*' queries.
+    try:
+        curs.execute("CREATE VIRTUAL TABLE IF NOT EXISTS task_fts USING fts5(label, content='task', content_rowid='id', prefix='2 3')")
+    except sqlite3.OperationalError as e:
+        if 'fts5' not in str(e):
+            raise
+
+        print("Qtask: WARNING: this SQLite library doesn't include FTS5, so 'qtask search' won't be available",
+              file=sys.stderr)
+        return
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_fts_insert AFTER INSERT ON task
+              BEGIN
+                 INSERT INTO task_fts (rowid, label) VALUES (NEW.id, NEW.label);
+              END
+    """)
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_fts_delete AFTER DELETE ON task
+              BEGIN
+                 INSERT INTO task_fts (task_fts, rowid, label) VALUES ('delete', OLD.id, OLD.label);
+              END
+    """)
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_fts_update AFTER UPDATE OF label ON task
+              BEGIN
+                 INSERT INTO task_fts (task_fts, rowid, label) VALUES ('delete', OLD.id, OLD.label);
+                 INSERT INTO task_fts (rowid, label) VALUES (NEW.id, NEW.label);
+              END
+    """)
+
+    curs.execute("INSERT INTO task_fts (task_fts) VALUES ('rebuild')")
+
+
+def migrate_add_task_closure(curs):
+    # Every (ancestor, descendant) pair of the task.parent_id hierarchy, so the total time under
+    # a task can be summed without walking the tree.  A task isn't stored as its own ancestor.
+    curs.execute("""
+              CREATE TABLE IF NOT EXISTS task_closure (
+                 ancestor_id       integer not null,
+                 descendant_id     integer not null,
+                 depth             integer not null,
+                 PRIMARY KEY (ancestor_id, descendant_id)
+              ) WITHOUT ROWID
+    """)
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_task_closure_descendant_id ON task_closure (descendant_id)")
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_closure_insert AFTER INSERT ON task
+              WHEN NEW.parent_id IS NOT NULL
+              BEGIN
+                 INSERT INTO task_closure (ancestor_id, descendant_id, depth)
+                      SELECT NEW.parent_id, NEW.id, 1
+                      UNION ALL
+                      SELECT ancestor_id, NEW.id, depth + 1 FROM task_closure WHERE descendant_id = NEW.parent_id;
+              END
+    """)
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_closure_delete AFTER DELETE ON task
+              BEGIN
+                 DELETE FROM task_closure WHERE descendant_id = OLD.id OR ancestor_id = OLD.id;
+              END
+    """)
+
+    # moving a task moves its whole subtree: drop the paths from its old ancestors and add ones from the new
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_closure_update AFTER UPDATE OF parent_id ON task
+              WHEN OLD.parent_id IS NOT NEW.parent_id
+              BEGIN
+                 DELETE FROM task_closure
+                  WHERE descendant_id IN (SELECT descendant_id FROM task_closure WHERE ancestor_id = OLD.id UNION SELECT OLD.id)
+                    AND ancestor_id NOT IN (SELECT descendant_id FROM task_closure WHERE ancestor_id = OLD.id UNION SELECT OLD.id);
+                 INSERT INTO task_closure (ancestor_id, descendant_id, depth)
+                      SELECT a.ancestor_id, s.descendant_id, a.depth + s.depth + 1
+                        FROM (SELECT ancestor_id, depth FROM task_closure WHERE descendant_id = NEW.parent_id
+                              UNION ALL SELECT NEW.parent_id, 0) a,
+                             (SELECT descendant_id, depth FROM task_closure WHERE ancestor_id = OLD.id
+                              UNION ALL SELECT OLD.id, 0) s
+                       WHERE NEW.parent_id IS NOT NULL;
+              END
+    """)
+
+    # nothing set parent_id before now, but fill in any hierarchy which is already there
+    curs.execute("DELETE FROM task_closure")
+    curs.execute("""
+              INSERT INTO task_closure (ancestor_id, descendant_id, depth)
+                   WITH RECURSIVE pairs (ancestor_id, descendant_id, depth) AS (
+                        SELECT parent_id, id, 1 FROM task WHERE parent_id IS NOT NULL
+                        UNION
+                        SELECT t.parent_id, pairs.descendant_id, pairs.depth + 1
+                          FROM pairs
+                               JOIN task t ON t.id=pairs.ancestor_id
+                         WHERE t.parent_id IS NOT NULL
+                   )
+                   SELECT ancestor_id, descendant_id, MIN(depth) FROM pairs GROUP BY ancestor_id, descendant_id
+    """)
+
+
+def migrate_add_sync_tracking(curs):
+    # What 'qtask sync' needs to merge databases: an ID for each database, one for each task that
+    # holds across databases, and a change counter stamped on every project and task as it's
+    # written, so only what changed since the last sync has to be exchanged.
+    curs.execute("CREATE TABLE IF NOT EXISTS qtask_meta (key text primary key, value)")
+    curs.execute("INSERT OR IGNORE INTO qtask_meta (key, value) VALUES ('db_uuid', lower(hex(randomblob(16))))")
+    curs.execute("INSERT OR IGNORE INTO qtask_meta (key, value) VALUES ('change_counter', 1)")
+
+    # how far this database has got with each other one it syncs with, as change counter values
+    curs.execute("""
+              CREATE TABLE IF NOT EXISTS sync_state (
+                 peer_uuid         text primary key,
+                 pulled            integer not null,
+                 pushed            integer not null
+              )
+    """)
+
+    # Time logged is a counter per (task, database it was logged in).  Each database only adds to
+    # its own, so merging two copies is just taking the larger of each, and task.time_logged is
+    # their sum.  Increments made on two machines are both kept however the syncs are ordered.
+    curs.execute("""
+              CREATE TABLE IF NOT EXISTS task_time (
+                 task_id           integer not null,
+                 origin            text not null,
+                 minutes           real not null,
+                 PRIMARY KEY (task_id, origin)
+              ) WITHOUT ROWID
+    """)
+
+    for table in ('project', 'task'):
+        curs.execute("PRAGMA table_info({0})".format(table))
+        columns = [row[1] for row in curs.fetchall()]
+
+        if table == 'task' and 'uuid' not in columns:
+            curs.execute("ALTER TABLE task ADD COLUMN uuid text")
+        if 'modified' not in columns:
+            curs.execute("ALTER TABLE {0} ADD COLUMN modified integer".format(table))
+
+    # existing rows all count as changed once, so the first sync with anything exchanges them
+    curs.execute("UPDATE project SET modified = 1 WHERE modified IS NULL")
+
+    curs.execute("SELECT MIN(id), MAX(id) FROM task WHERE uuid IS NULL")
+    (min_id, max_id) = curs.fetchone()
+
+    if min_id is not None:
+        for chunk_start in range(min_id, max_id + 1, MIGRATION_CHUNK_SIZE):
+            curs.execute('''UPDATE task SET uuid = lower(hex(randomblob(16))), modified = 1
+                             WHERE id >= ? AND id < ? AND uuid IS NULL''',
+                         (chunk_start, chunk_start + MIGRATION_CHUNK_SIZE))
+            curs.execute('''INSERT OR IGNORE INTO task_time (task_id, origin, minutes)
+                                SELECT id, (SELECT value FROM qtask_meta WHERE key = 'db_uuid'), time_logged
+                                  FROM task
+                                 WHERE id >= ? AND id < ? AND time_logged IS NOT NULL''',
+                         (chunk_start, chunk_start + MIGRATION_CHUNK_SIZE))
+
+    curs.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_task_uuid ON task (uuid)")
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_task_modified ON task (modified)")
+    curs.execute("CREATE INDEX IF NOT EXISTS idx_project_modified ON project (modified)")
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_project_sync_insert AFTER INSERT ON project
+              BEGIN
+                 UPDATE qtask_meta SET value = value + 1 WHERE key = 'change_counter';
+                 UPDATE project SET modified = (SELECT value FROM qtask_meta WHERE key = 'change_counter') WHERE id = NEW.id;
+              END
+    """)
+
+    # While a sync is writing, qtask_meta has a 'syncing' key and time merged in from elsewhere
+    # isn't counted as logged here.
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_sync_insert AFTER INSERT ON task
+              BEGIN
+                 UPDATE qtask_meta SET value = value + 1 WHERE key = 'change_counter';
+                 UPDATE task
+                    SET uuid = COALESCE(NEW.uuid, lower(hex(randomblob(16)))),
+                        modified = (SELECT value FROM qtask_meta WHERE key = 'change_counter')
+                  WHERE id = NEW.id;
+                 INSERT INTO task_time (task_id, origin, minutes)
+                      SELECT NEW.id, (SELECT value FROM qtask_meta WHERE key = 'db_uuid'), NEW.time_logged
+                       WHERE NEW.time_logged IS NOT NULL
+                             AND (SELECT value FROM qtask_meta WHERE key = 'syncing') IS NULL;
+              END
+    """)
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_sync_update AFTER UPDATE OF label, time_added, time_logged, project_id, parent_id ON task
+              BEGIN
+                 UPDATE qtask_meta SET value = value + 1 WHERE key = 'change_counter';
+                 UPDATE task SET modified = (SELECT value FROM qtask_meta WHERE key = 'change_counter') WHERE id = NEW.id;
+                 INSERT INTO task_time (task_id, origin, minutes)
+                      SELECT NEW.id, (SELECT value FROM qtask_meta WHERE key = 'db_uuid'),
+                             COALESCE(NEW.time_logged, 0) - COALESCE(OLD.time_logged, 0)
+                       WHERE NEW.time_logged IS NOT OLD.time_logged
+                             AND (SELECT value FROM qtask_meta WHERE key = 'syncing') IS NULL
+                 ON CONFLICT (task_id, origin) DO UPDATE SET minutes = minutes + excluded.minutes;
+              END
+    """)
+
+    curs.execute("""
+              CREATE TRIGGER IF NOT EXISTS trg_task_sync_delete AFTER DELETE ON task
+              BEGIN
+                 DELETE FROM task_time WHERE task_id = OLD.id;
+              END
+    """)
+
+
+# Schema changes after the original release, in order.  A database's position in this
+# list is tracked in PRAGMA user_version, so entries must only ever be appended.
+MIGRATIONS = [
+    ('integer epoch copy of task.time_added', migrate_add_time_added_epoch),
+    ('project label and per-project task indexes', migrate_add_lookup_indexes),
+    ('daily per-project time rollups', migrate_add_daily_rollups),
+    ('write-ahead log journaling', migrate_enable_wal),
+    ('full-text index of task labels', migrate_add_label_search),
+    ('task hierarchy closure table', migrate_add_task_closure),
+    ('row identities and change tracking for sync', migrate_add_sync_tracking),
+    ('dates of tasks logged with dates in other formats', migrate_repair_legacy_dates),
+]
+
+
+def upgrade_db(conn, verbose=True):
+    curs = conn.cursor()
+    curs.execute("PRAGMA user_version")
+    version = curs.fetchone()[0]
+
+    if version > len(MIGRATIONS):
+        print_error("Qtask: ERROR: the db file uses schema version {0} but this qtask only knows up to {1}.  " \
+                    "Please upgrade qtask.".format(version, len(MIGRATIONS)))
+
+    # Each step holds the write lock and checks the version again first, so when several
+    # processes open an old DB at once the others wait and then skip what's already been done.
+    while version < len(MIGRATIONS):
+        curs.execute("BEGIN IMMEDIATE")
+        curs.execute("PRAGMA user_version")
+        version = curs.fetchone()[0]
+
+        if version >= len(MIGRATIONS):
+            conn.commit()
+            break
+
+        (description, migration) = MIGRATIONS[version]
+        if verbose:
+            print("Qtask: upgrading database to schema version {0} ({1})".format(version + 1, description), file=sys.stderr)
+
+        migration(curs)
+
+        # a step which had to let go of the lock (see migrate_enable_wal()) may have been overtaken
+        curs.execute("PRAGMA user_version")
+        if curs.fetchone()[0] == version:
+            curs.execute("PRAGMA user_version = {0:d}".format(version + 1))
+        conn.commit()
+
+    curs.close()
+
+def check_limit(limit):
+    if limit is not None and limit < 1:
+        print_error("Qtask: Sorry, --limit must be at least 1, not {0}".format(limit))
+
+
+def list_tasks(curs, project_id=None, from_date=None, until=None, group_by=None, output_format='text', limit=None, after=None):
+    """
+    Lists work logged, most recent first.  Results can be paged through with limit and after,
+    a cursor of the form '<time_added_epoch>:<id>' (as printed at the end of each page) naming
+    the last task already seen.  Pages are found by seeking the time_added_epoch indexes rather
+    than skipping over earlier rows.
+
+    Only the yearly archives overlapping the date range (and page) are read, and when listing
+    only once the work listed has got back to their year, so a page of recent work never
+    touches the archived history.
+    """
+    check_limit(limit)
     qry_args = list()
-    qry_str = '''
-    SELECT t.id, t.label AS task_label, t.time_added, t.time_logged, p.label AS project_name
-      FROM task t
-           LEFT JOIN project p ON t.project_id=p.id
+
+    archive_until = until
+    if after is not None:
+        after_epoch = parse_page_cursor(after)[0]
+        if archive_until is None or after_epoch < archive_until:
+            archive_until = after_epoch + 1
+
+    # the first three columns are what the rows are sorted by (see iter_task_query())
+    if output_format == 'text':
+        columns = ['id', 'task_label', 'time_added', 'time_logged', 'project_name']
+        qry_str = '''
+        SELECT COALESCE(p.label, 'Other (no project)'), t.time_added_epoch, t.id,
+               t.id, t.label, t.time_added, t.time_logged, p.label
+        '''
+    else:
+        # raw values for other programs: ISO timestamps, minutes and IDs
+        columns = ['id', 'parent_id', 'project_id', 'project_label', 'time_added', 'time_logged', 'label']
+        qry_str = '''
+        SELECT COALESCE(p.label, 'Other (no project)'), t.time_added_epoch, t.id,
+               t.id, t.parent_id, t.project_id, p.label,
+               strftime('%Y-%m-%dT%H:%M:%S', t.time_added_epoch, 'unixepoch'), t.time_logged, t.label
+        '''
+
+    qry_str += '''
+      FROM {tasks} t
+           LEFT JOIN {projects} p ON t.project_id=p.id
     '''
     if project_id is not None:
-        qry_str += " WHERE p.id = ? "
+        qry_str += " WHERE t.project_id = ? "
         qry_args.append(project_id)
 
-    if from_date is not None:
-        if 'WHERE' in qry_str:
-            qry_str += " AND t.time_added BETWEEN ? AND ? "
-        else:
-            qry_str += " WHERE t.time_added BETWEEN ? AND ? "
+    # the date range is given as epoch seconds, from_date inclusive and until exclusive
+    if from_date is not None:
+        qry_str += " AND " if 'WHERE' in qry_str else " WHERE "
+        qry_str += " t.time_added_epoch >= ? "
+        qry_args.append(from_date)
+
+    if until is not None:
+        qry_str += " AND " if 'WHERE' in qry_str else " WHERE "
+        qry_str += " t.time_added_epoch < ? "
+        qry_args.append(until)
+
+    if after is not None:
+        (after_epoch, after_id) = parse_page_cursor(after)
+        qry_str += " AND " if 'WHERE' in qry_str else " WHERE "
+        qry_str += " t.time_added_epoch <= ? AND (t.time_added_epoch < ? OR t.id < ?) "
+        qry_args.extend([after_epoch, after_epoch, after_id])
+
+    archive_years = get_archive_years(curs, from_date, archive_until)
+
+    if group_by == 'project' and project_id is None:
+        # Reports read one project at a time in label order, each newest first down
+        # idx_task_project_time_added_epoch.  Ordering the whole query by label instead would have
+        # SQLite sort every row before the first section could be printed.
+        qry_str += " AND " if 'WHERE' in qry_str else " WHERE "
+        qry_str += " t.project_id IS ? ORDER BY t.time_added_epoch DESC, t.id DESC "
+
+        curs.execute('''SELECT id FROM (SELECT id, label FROM project UNION ALL SELECT NULL, 'Other (no project)')
+                         ORDER BY label''')
+        project_ids = [row[0] for row in curs.fetchall()]
+        rows = itertools.chain.from_iterable(iter_task_query(curs, qry_str, qry_args + [report_project_id], archive_years)
+                                             for report_project_id in project_ids)
+    else:
+        qry_str += " ORDER BY t.time_added_epoch DESC, t.id DESC "
+
+        # each DB file gets the limit, and the merged rows are cut off at it again
+        if limit is not None:
+            qry_str += " LIMIT ? "
+            qry_args.append(limit)
+
+        rows = iter_task_query(curs, qry_str, qry_args, archive_years)
+        if limit is not None:
+            rows = itertools.islice(rows, limit)
+
+    last_row = None
+
+    def drop_sort_columns(rows):
+        nonlocal last_row
+        for row in rows:
+            last_row = row
+            yield row[3:]
+
+    if output_format != 'text':
+        row_count = write_rows(drop_sort_columns(rows), columns, output_format)[0]
+
+        # keep the cursor out of the data itself
+        if limit is not None and row_count == limit:
+            print("# Next page: --after {0}".format(get_page_cursor(last_row[1], last_row[2])), file=sys.stderr)
+        return
+
+    work_count = 0
+
+    print("# Work logged\n# -----------")
+
+    if group_by == None:
+        for (task_id, task_label, time_added, time_logged, project_name) in drop_sort_columns(rows):
+            work_count += 1
+            time_logged = time_logged_string(time_logged)
+            time_added = time_added.split('.')[0]
+            print("{0}\t{1}\t{2}\t{3}\t{4}".format(task_id, project_name, time_added, time_logged, task_label))
+    elif group_by == 'project':
+        current_project = None
+        project_minutes = 0
+
+        for (task_id, task_label, time_added, time_logged, project_name) in drop_sort_columns(rows):
+            work_count += 1
+
+            if project_name == None:
+                project_name = 'Other (no project)'
+
+            if project_name != current_project:
+                if current_project is not None:
+                    print_project_total(project_minutes)
+
+                current_project = project_name
+                project_minutes = 0
+                print("\n{0}\n{1}".format(project_name, '-' * len(project_name)))
+
+            if time_logged is not None:
+                project_minutes += time_logged
+
+            print("{0}\t{1}\t{2}\t{3}".format(task_id, time_added.split('.')[0], time_logged_string(time_logged), task_label))
+
+        if current_project is not None:
+            print_project_total(project_minutes)
+            
+    if work_count == 0:
+        print("#- No work logged -#")
+    elif limit is not None and work_count == limit:
+        print("# Next page: --after {0}".format(get_page_cursor(last_row[1], last_row[2])))
+
+
+def iter_task_query(curs, qry_str, qry_args, archive_years, newest_first=True):
+    """
+    Runs a query over tasks against the connected DB and the given yearly archives, yielding
+    all their rows in one order.  The query reads FROM {tasks} t LEFT JOIN {projects} p, and
+    its first three columns are what it's ordered by: project label, time_added_epoch and id.
+    Rows come newest first, or by project label first if not newest_first.
+
+    Each archive is read on a read-only connection of its own, so there's no limit on how many
+    years there are.  Newest first, an archive is only opened once the rows from the connected
+    DB have got back to its year, since it holds nothing from later.
+    """
+    db_file_path = get_connected_db_path(curs)
+    curs.execute(qry_str.format(tasks='main.task', projects='main.project'), qry_args)
+    rows = itertools.chain.from_iterable(iter(lambda: curs.fetchmany(REPORT_FETCH_SIZE), []))
+
+    if not archive_years:
+        yield from rows
+        return
+
+    import heapq
+
+    # NULL epochs sort last, as they do in the queries
+    if newest_first:
+        sort_key = lambda row: (row[1] is None, -(row[1] or 0), -row[2])
+    else:
+        sort_key = lambda row: (row[0], row[1] is None, -(row[1] or 0), -row[2])
+
+    archives = [(year, iter_archive_query(db_file_path, year, qry_str, qry_args)) for year in sorted(archive_years, reverse=True)]
+
+    if not newest_first:
+        yield from heapq.merge(rows, *[archive_rows for (year, archive_rows) in archives], key=sort_key)
+        return
+
+    for (year, archive_rows) in archives:
+        year_end = get_year_range(year)[1]
+
+        for row in rows:
+            if row[1] is None or row[1] < year_end:
+                rows = heapq.merge([row], rows, archive_rows, key=sort_key)
+                break
+
+            yield row
+        else:
+            rows = archive_rows
+
+    yield from rows
+
+
+def iter_archive_query(db_file_path, year, qry_str, qry_args):
+    """
+    Generator running a query from iter_task_query() against one yearly archive, with the DB
+    it belongs to attached for project labels
+    """
+    conn = sqlite3.connect(get_read_only_uri(get_archive_path(db_file_path, year)), uri=True)
+
+    try:
+        conn.execute("ATTACH DATABASE ? AS qtask", (get_read_only_uri(db_file_path),) )
+        curs = conn.execute(qry_str.format(tasks='main.task', projects='qtask.project'), qry_args)
+        yield from itertools.chain.from_iterable(iter(lambda: curs.fetchmany(REPORT_FETCH_SIZE), []))
+    finally:
+        conn.close()
+
+
+def list_task_tree(curs, task_id):
+    """
+    Prints a task and all of its subtasks as an indented tree.  Each line shows the time logged
+    against that task itself and the total for it plus everything under it.
+    """
+    # The tree is walked with one recursive query, ordered by a path of zero-padded IDs so each
+    # subtask comes right after its parent.  Subtree totals come from the task_closure table.
+    curs.execute('''
+    WITH RECURSIVE tree (id, depth, path) AS (
+         SELECT id, 0, printf('%012d', id) FROM task WHERE id = ?
+         UNION ALL
+         SELECT t.id, tree.depth + 1, tree.path || '/' || printf('%012d', t.id)
+           FROM task t
+                JOIN tree ON t.parent_id=tree.id
+    ),
+    subtree_totals (id, minutes) AS (
+         SELECT c.ancestor_id, SUM(d.time_logged)
+           FROM task_closure c
+                JOIN task d ON c.descendant_id=d.id
+          WHERE c.ancestor_id IN (SELECT id FROM tree)
+       GROUP BY c.ancestor_id
+    )
+    SELECT t.id, tree.depth, t.label, t.time_added, t.time_logged,
+           COALESCE(t.time_logged, 0) + COALESCE(st.minutes, 0)
+      FROM tree
+           JOIN task t ON tree.id=t.id
+           LEFT JOIN subtree_totals st ON st.id=t.id
+     ORDER BY tree.path
+    ''', (task_id,) )
+
+    print("# Task tree\n# ---------")
+
+    for (id, depth, label, time_added, time_logged, total_minutes) in curs:
+        print("{0}\t{1}\t{2}\t{3}\t{4}{5}".format(id, time_added.split('.')[0], time_logged_string(time_logged),
+                                                time_logged_string(total_minutes), '  ' * depth, label))
+
+
+def list_totals(curs, bucket=None, from_date=None, until=None, output_format='text'):
+    """
+    Prints time totals per project, optionally split into 'day' or 'week' buckets, read only
+    from the daily_project_totals rollup table.  Ranges are widened to whole days.
+    """
+    # days are counted from 1970-01-01, a Thursday, so this shifts a day back to its week's Monday
+    if bucket == 'day':
+        bucket_expr = "d.day"
+    elif bucket == 'week':
+        bucket_expr = "d.day - ((d.day + 3) % 7)"
+    else:
+        bucket_expr = "NULL"
+
+    qry_args = list()
+    qry_str = '''
+    SELECT {0} AS bucket, NULLIF(d.project_id, 0) AS project_id, COALESCE(p.label, 'Other (no project)') AS project_name,
+           SUM(d.task_count) AS task_count, SUM(d.minutes) AS minutes
+      FROM daily_project_totals d
+           LEFT JOIN project p ON d.project_id=p.id
+    '''.format(bucket_expr)
+
+    if from_date is not None:
+        qry_str += " AND " if 'WHERE' in qry_str else " WHERE "
+        qry_str += " d.day >= ? "
+        qry_args.append(from_date // 86400)
+
+    if until is not None:
+        qry_str += " AND " if 'WHERE' in qry_str else " WHERE "
+        qry_str += " d.day < ? "
+        qry_args.append(-(-until // 86400))
+
+    qry_str += " GROUP BY bucket, d.project_id ORDER BY bucket, project_name "
+
+    if output_format != 'text':
+        qry_str = '''
+        SELECT CASE WHEN bucket IS NULL THEN NULL ELSE date(bucket * 86400, 'unixepoch') END,
+               project_id, NULLIF(project_name, 'Other (no project)'), task_count, minutes
+          FROM ({0})
+        '''.format(qry_str)
+        curs.execute(qry_str, qry_args)
+        write_rows(curs, ['bucket', 'project_id', 'project_label', 'task_count', 'minutes'], output_format)
+        return
+
+    curs.execute(qry_str, qry_args)
+    row_count = 0
 
-        qry_args.append(from_date)
-        qry_args.append(until)
+    print("# Time totals\n# -----------")
 
-    qry_str += " ORDER BY t.time_added DESC "
+    for (bucket_day, project_id, project_name, task_count, minutes) in curs:
+        row_count += 1
+        columns = [project_name, "{0} tasks".format(task_count), time_logged_string(minutes)]
 
-    curs.execute(qry_str, (qry_args) )
-    work_count = 0
+        if bucket_day is not None:
+            columns.insert(0, datetime.date(1970, 1, 1) + datetime.timedelta(days=bucket_day))
 
-    print("# Work logged\n# -----------")
+        print("\t".join([str(c) for c in columns]))
 
-    # this will only be used if there's some grouping applied
-    task_groups = dict()
+    if row_count == 0:
+        print("#- No work logged -#")
 
-    if group_by == None:
-        for (task_id, task_label, time_added, time_logged, project_name) in curs:
-            work_count += 1
-            time_logged = time_logged_string(time_logged)
-            time_added = time_added.split('.')[0]
-            print("{0}\t{1}\t{2}\t{3}\t{4}".format(task_id, project_name, time_added, time_logged, task_label))
-    elif group_by == 'project':
-        for (task_id, task_label, time_added, time_logged, project_name) in curs:
-            work_count += 1
-            time_added = time_added.split('.')[0]
 
-            if project_name == None:
-                project_name = 'Other (no project)'
+def report_task_total(curs, task_id):
+    # the closure table holds every (ancestor, descendant) pair, so no tree walk is needed
+    curs.execute('''
+    SELECT COUNT(*), SUM(d.time_logged)
+      FROM task_closure c
+           JOIN task d ON c.descendant_id=d.id
+     WHERE c.ancestor_id = ?
+    ''', (task_id,) )
+    (subtask_count, subtask_minutes) = curs.fetchone()
 
-            if project_name not in task_groups:
-                task_groups[project_name] = list()
+    curs.execute('''SELECT label, time_logged FROM task WHERE id = ?''', (task_id,) )
+    (label, time_logged) = curs.fetchone()
+    total_minutes = (time_logged or 0) + (subtask_minutes or 0)
 
-            task_groups[project_name].append({'id':task_id, 'task_label':task_label, 'time_added':time_added, 'time_logged':time_logged})
+    print("# Time under task {0}\n# ----------------".format(task_id))
+    print("{0}\t{1} subtasks\t{2}\t{3}".format(task_id, subtask_count, time_logged_string(total_minutes), label))
 
-        for project_name in sorted(task_groups):
-            print("\n{0}\n{1}".format(project_name, '-' * len(project_name)))
 
-            for task in task_groups[project_name]:
-                time_logged = time_logged_string(task['time_logged'])
-                print("{0}\t{1}\t{2}\t{3}".format(task['id'], task['time_added'], time_logged, task['task_label']))
-            
-    if work_count == 0:
-        print("#- No work logged -#")
+def parse_page_cursor(value):
+    try:
+        (epoch, task_id) = value.split(':')
+        return (int(epoch), int(task_id))
+    except ValueError:
+        print_error("Qtask: Sorry, '{0}' isn't a valid --after value.  Use the one printed at the end of a page.".format(value))
+
 
-    
 def print_error(msg):
-    print(msg)
-    sys.exit(1)
+    """
+    Abandons the current command with a message for the user.  Whatever is running the command
+    (main(), a batch/shell session or the daemon) catches this, prints the message and decides
+    whether to carry on.
+    """
+    raise QtaskError(msg)
 
     
+def print_project_total(minutes):
+    print("Total:\t{0}".format(time_logged_string(minutes)))
+
+
 def print_help_for_command(cmd):
     if cmd == 'init':
         print("""
@@ -218,6 +1744,26 @@ def print_help_for_command(cmd):
         quotation marks.
         """)
 
+    elif cmd == 'archive':
+        print("""
+        Qtask help command: archive
+
+        The 'archive' command moves work logged before a date out of the database into one
+        file per year next to it (e.g. ~/.qtask.db.archive-2014), keeping the database itself
+        small and quick to back up.  Archived work still shows up in list and report whenever
+        the dates asked about reach back that far, and still counts towards 'report totals'.
+        Only the archives covering those dates are opened, so recent work is listed as fast
+        as ever.
+
+        Tasks with subtasks or a parent task are left where they are.  Archived tasks can't be
+        searched, have time logged against them or be listed with 'list task'.
+
+        Example usage:
+
+           qtask archive before 2022-01-01
+
+        """)
+
     elif cmd == 'help':
         print("""
         Qtask help command: help
@@ -235,6 +1781,165 @@ def print_help_for_command(cmd):
 
         """)
 
+    elif cmd == 'batch' or cmd == 'shell':
+        print("""
+        Qtask help command: batch / shell
+
+        These run many qtask commands, one per line, on a single database connection, which
+        is much faster than starting qtask once per command.  'batch' reads the commands from
+        a file (or STDIN if the file is '-' or omitted) and 'shell' prompts for them.  Lines
+        are written just as on the command line, optionally starting with 'qtask', and lines
+        starting with '#' are ignored.
+
+        A command which fails is reported and undone on its own while the session carries on.
+        Work is committed every --commit_interval commands (100 by default for batch, after
+        every command for shell) and at the end.
+
+        Example usage:
+
+           qtask batch commands.txt
+           grep '^qtask' load_examples.sh | qtask batch -
+           qtask --commit_interval 500 batch commands.txt
+           qtask shell
+
+        """)
+
+    elif cmd == 'search':
+        print("""
+        Qtask help command: search
+
+        The 'search' command finds logged work by the words in its label, best matches first.
+        Put the search itself in quotes if it's more than one word.  All words must match,
+        a quoted phrase must match exactly and a trailing * matches any word starting with
+        what comes before it.  Results can be limited to one project and to any of the date
+        ranges the list command understands, and --limit sets how many are shown (default 50).
+        --format tsv|csv|jsonl gives the same columns as 'list work' does for other programs.
+
+        Example usage:
+
+            qtask search bowtie
+            qtask search 'bowtie index'
+            qtask search '"genome index"'
+            qtask search 'jbrow*' in Annotation
+            qtask search meeting in last 2 weeks
+            qtask --limit 10 search 'conference call' in Annotation between 2015-01-01 and 2015-03-31
+
+        """)
+
+    elif cmd == 'serve':
+        print("""
+        Qtask help command: serve
+
+        Starts a long-running daemon which keeps the database open and listens on a Unix
+        domain socket next to the DB file (e.g. ~/.qtask.db.sock).  While it's running, the
+        add, log, list and report commands are handed to the daemon instead of opening the
+        database themselves, which makes them much quicker when called from editor plugins or
+        git hooks.  If no daemon is running, qtask simply works directly as usual.
+
+        Stop the daemon with Ctrl-C or 'kill'.
+
+        Example usage:
+
+           qtask serve &
+           qtask -d ~/work.qtask.db serve &
+
+        """)
+
+    elif cmd == 'maintain':
+        print("""
+        Qtask help command: maintain
+
+        The 'maintain' command looks after the database: it checks it for corruption, updates
+        the statistics SQLite uses to plan queries, hands space freed by deleted or archived
+        tasks back to the filesystem and copies the write-ahead log into the database.  It then
+        prints the database's size and how many rows each table holds.  If the check finds a
+        problem it says so and exits with status 1.
+
+        It's safe to run from cron while qtask is being used, since each step only holds the
+        database for a moment.  'maintain full' does a slower, complete check and rewrites the
+        whole file, which also turns on freeing space for databases created by older versions
+        of qtask.  Other qtask commands which write have to wait while it runs.
+
+        Example usage:
+
+           qtask maintain
+           qtask maintain full
+
+           # in a crontab, every night at 3am
+           0 3 * * * qtask maintain > /dev/null
+
+        """)
+
+    elif cmd == 'status':
+        print("""
+        Qtask help command: status
+
+        The 'status' command prints a short summary: the time logged today, this week's time
+        per project (weeks start on Monday) and the last task logged.
+
+        Every command which writes to the database also saves this summary to a small file
+        next to it (e.g. ~/.qtask.db.status).  With --fast, status just prints that file without
+        opening the database, which makes it quick enough to run from a shell prompt.  If the
+        file is from a previous day, or the database has been changed since by something else
+        (such as another copy of qtask writing to it over a network share), the summary is
+        worked out from the database again instead.  --format jsonl prints it as JSON.
+
+        Example usage:
+
+           qtask status
+           qtask status --fast
+           qtask --format jsonl status --fast
+
+           # in ~/.bashrc
+           PS1='[$(qtask status --fast | head -1 | cut -f2)] \\w\\$ '
+
+        """)
+
+    elif cmd == 'sync':
+        print("""
+        Qtask help command: sync
+
+        The 'sync' command merges another qtask database (e.g. one on your laptop) with this
+        one, both ways, so afterwards each holds all the projects, tasks and time logged in
+        either.  Projects are matched up by name, and time logged against the same task in
+        both places is added together.  Only what changed since the two were last synced is
+        exchanged, so syncing often stays quick.
+
+        Both databases must have been started with 'qtask init'.  A copy of the database file
+        can't be used, because time logged in the copy couldn't be told apart from the original.
+        Archived work isn't synced.
+
+        Example usage:
+
+           qtask sync /mnt/laptop/home/me/.qtask.db
+           qtask -d ~/work.qtask.db sync ~/home.qtask.db
+
+        """)
+
+    elif cmd == 'import':
+        print("""
+        Qtask help command: import
+
+        The 'import' command bulk-loads tasks from a CSV or JSONL file (or from STDIN if the file
+        is '-' or omitted) within a single connection and transaction.  CSV files need a header
+        row.  Recognized columns/keys are:
+
+           label        (required) the task description
+           project      label of the project to log the task to
+           time_added   date or date/time of the task (defaults to now)
+           time_logged  minutes spent on the task
+
+        Projects must already exist unless --create_projects is passed.  Rows which can't be
+        loaded are reported and skipped rather than aborting the whole import.
+
+        Example usage:
+
+           qtask import tracker_export.csv
+           qtask --create_projects import tracker_export.jsonl
+           cat tracker_export.jsonl | qtask import -
+
+        """)
+
     elif cmd == 'log':
         print("""
         Qtask help command: log
@@ -251,6 +1956,10 @@ def print_help_for_command(cmd):
            qtask log "Submitted timesheets" on 2015-01-13
            qtask log "Created bowtie2 index of genomes" to Annotation on 2015-01-21
            qtask log 5 hours against task 231
+           qtask log 1.5 hours against task 231
+           qtask log "Ran the aligner on sample 3" under task 231
+
+        Tasks logged 'under' another become its subtasks and are filed to the same project.
 
         """)
 
@@ -271,49 +1980,744 @@ def print_help_for_command(cmd):
             qtask list Annotation work
             qtask list work in last 30 days
             qtask list Annotation work in last 1 week
+            qtask list work between 2015-02-10 and 2015-02-17
+
+        A task can also be listed along with all its subtasks as a tree, showing the time
+        logged against each one and the total for everything under it:
+
+            qtask list task 231
+
+        Long histories can be paged through, most recent first, with --limit.  Each full page
+        ends with the --after value which gets the next one:
+
+            qtask --limit 20 list work
+            qtask --limit 20 --after 1421835072:231 list work
+
+        For reading by other programs, work, projects and reports can instead be written as
+        tsv, csv or jsonl with --format.  These have raw values (minutes, ISO timestamps and
+        project IDs) and are streamed straight from the database however long they are.  Task
+        trees are only drawn as text:
+
+            qtask --format csv list work in last 30 days
+            qtask --format jsonl report work
+            qtask --format tsv list projects
+
+        """)
+
+    elif cmd == 'report':
+        print("""
+        Qtask help command: report
+        
+        The 'report' command is used group and display work logged by project over a given time
+        interval.
+
+        Example usage:
+
+            qtask report work in last 30 days
+            qtask report work in last 1 week
+
+        Totals per project can be reported without listing each task, optionally broken down
+        by day or by week (weeks start on Monday).  These come from a per-day summary table, so
+        date ranges are widened to whole days:
+
+            qtask report totals
+            qtask report totals in last 52 weeks
+            qtask report totals by week in last 52 weeks
+            qtask report totals by day between 2015-02-01 and 2015-02-28
+
+        The total time logged against a task and all of its subtasks is reported with:
+
+            qtask report task 231
+
+        If the totals ever look wrong they can be recomputed from the logged tasks with:
+
+            qtask rebuild-rollups
+
+        Work logged by a whole team can be reported together by giving each person's DB file,
+        a directory of them or a glob pattern.  Projects are matched up by name, and each one's
+        total is broken down by person (named after their DB files):
+
+            qtask -d team/ report work in last 4 weeks
+            qtask -d alice.qtask.db -d bob.qtask.db report Annotation work in last 30 days
+            qtask -d 'team/*.qtask.db' --format csv report work
+        
+        """)
+        
+    else:
+        print_error("Qtask: Sorry, help for the command ({0}) is not yet implemented".format(cmd))
+
+        
+def process_add_command(store, item_type, label):
+    print("Attempting to insert project: {0}".format(label))
+    
+    if item_type == 'project':
+        row_id = store.add_project(label)
+        print("Qtask: Project '{0}' added to the database with id={1}".format(label, row_id))
+        return row_id
+    else:
+        print_error("Qtask: Sorry, there is currently only support for adding projects")
+
+def process_archive_command(curs, args):
+    """
+    Moves tasks logged before a date out of the main DB into one archive file per year.  The
+    daily rollups keep counting them, and list and report read the archives back when asked
+    about dates they cover.
+    """
+    # qtask archive before 2022-01-01
+    if len(args) != 3 or args[1] != 'before':
+        print_error("Usage: qtask archive before <date>")
+
+    if curs.connection.in_transaction:
+        print_error("Qtask: Sorry, archive can't be run as part of a batch or shell session")
+
+    cutoff = get_user_date_epoch(args[2])
+
+    curs.execute('''SELECT CAST(strftime('%Y', MIN(time_added_epoch), 'unixepoch') AS INTEGER),
+                           CAST(strftime('%Y', ?, 'unixepoch') AS INTEGER)
+                      FROM task
+                     WHERE time_added_epoch < ?''', (cutoff - 1, cutoff) )
+    (first_year, last_year) = curs.fetchone()
+    archived_count = 0
+
+    if first_year is not None:
+        for year in range(first_year, last_year + 1):
+            (year_start, year_end) = get_year_range(year)
+            archived_count += archive_tasks(curs, year, year_start, min(year_end, cutoff))
+
+    print("Qtask: archived {0} tasks logged before {1}".format(archived_count, args[2]))
+
+
+def archive_tasks(curs, year, from_date, until):
+    """
+    Moves the tasks logged in [from_date, until), all within one year, to that year's archive
+    file, committing once they're moved.  Returns how many there were.
+    """
+    # tasks with a parent or subtasks stay behind, so task trees and their totals stay whole
+    where = '''time_added_epoch >= ? AND time_added_epoch < ? AND parent_id IS NULL
+               AND NOT EXISTS (SELECT 1 FROM task_closure c WHERE c.ancestor_id = task.id)'''
+    columns = 'id, parent_id, label, time_added, time_logged, project_id, time_added_epoch'
+
+    curs.execute("SELECT COUNT(*) FROM task WHERE " + where, (from_date, until) )
+    task_count = curs.fetchone()[0]
+    if task_count == 0:
+        return 0
+
+    # Main's write lock is held from here until the tasks are deleted, so they can't change
+    # after they're copied.  The copy is committed to the archive file first, on a connection of
+    # its own, as SQLite doesn't commit a transaction across two files in WAL mode atomically.
+    # If qtask stops in between the tasks are in both files, and archiving again replaces the
+    # archive's copies and deletes them here.
+    curs.execute("BEGIN IMMEDIATE")
+    copy_tasks_to_archive(get_connected_db_path(curs), year, columns, where, (from_date, until))
+
+    # deleting the tasks takes them out of the rollups too, so put their totals back afterwards
+    curs.execute('''SELECT time_added_epoch / 86400, COALESCE(project_id, 0), COUNT(*), SUM(COALESCE(time_logged, 0))
+                      FROM main.task
+                     WHERE {0}
+                  GROUP BY 1, 2'''.format(where), (from_date, until) )
+    totals = curs.fetchall()
+
+    curs.execute("DELETE FROM main.task WHERE " + where, (from_date, until) )
+    task_count = curs.rowcount
+    add_rollup_totals(curs, totals)
+
+    # so 'qtask sync' doesn't bring archived work back in from another database
+    curs.execute('''INSERT INTO qtask_meta (key, value) VALUES ('archived_before', ?)
+                   ON CONFLICT (key) DO UPDATE SET value = MAX(value, excluded.value)''', (until,) )
+    curs.connection.commit()
+
+    return task_count
+
+
+def copy_tasks_to_archive(db_file_path, year, columns, where, where_args):
+    """
+    Copies the tasks matching a WHERE clause from a DB into its archive file for a year,
+    creating that if needed, and commits them there
+    """
+    archive_conn = sqlite3.connect(get_archive_path(db_file_path, year))
+
+    try:
+        archive_conn.execute("ATTACH DATABASE ? AS qtask", (get_read_only_uri(db_file_path),) )
+        archive_conn.execute("BEGIN IMMEDIATE")
+        archive_conn.execute('''CREATE TABLE IF NOT EXISTS main.task (
+                                  id                integer primary key,
+                                  parent_id         integer,
+                                  label             text,
+                                  time_added        text,
+                                  time_logged       real,
+                                  project_id        integer,
+                                  time_added_epoch  integer
+                               )''')
+        archive_conn.execute("CREATE INDEX IF NOT EXISTS main.idx_task_time_added_epoch ON task (time_added_epoch)")
+        archive_conn.execute("CREATE INDEX IF NOT EXISTS main.idx_task_project_time_added_epoch ON task (project_id, time_added_epoch)")
+        archive_conn.execute("INSERT OR REPLACE INTO main.task ({0}) SELECT {0} FROM qtask.task WHERE {1}".format(columns, where),
+                             where_args)
+        archive_conn.commit()
+    finally:
+        archive_conn.close()
+
+
+def process_maintain_command(curs, args):
+    """
+    Database upkeep, safe to run from cron while qtask is in use: checks the DB's integrity,
+    refreshes the query planner's statistics, hands freed pages back to the filesystem and
+    checkpoints the write-ahead log, then prints size and row count statistics.  Each step is
+    its own short transaction, so other processes are never locked out for long.
+    """
+    # qtask maintain
+    # qtask maintain full
+    if len(args) > 2 or (len(args) == 2 and args[1] != 'full'):
+        print_error("Usage: qtask maintain [full]")
+
+    full = len(args) == 2
+    conn = curs.connection
+
+    if conn.in_transaction:
+        print_error("Qtask: Sorry, maintain can't be run as part of a batch or shell session")
+
+    db_path = get_connected_db_path(curs)
+    print("Qtask: maintaining {0}".format(db_path))
+
+    # 'full' does the complete (and much slower) check which also compares every index to its table
+    check = 'integrity_check' if full else 'quick_check'
+    curs.execute("PRAGMA {0}".format(check))
+    problems = [row[0] for row in curs.fetchall() if row[0] != 'ok']
+    print("  {0}: {1}".format(check, 'ok' if not problems else "{0} problems".format(len(problems))))
+
+    # the search index only holds copies of task labels, so if it's gone wrong it can just be rebuilt
+    curs.execute("SELECT name FROM sqlite_master WHERE name = 'task_fts'")
+    if curs.fetchone() is not None:
+        try:
+            curs.execute("INSERT INTO task_fts (task_fts) VALUES ('integrity-check')")
+            print("  search index: ok")
+        except sqlite3.DatabaseError as e:
+            curs.execute("INSERT INTO task_fts (task_fts) VALUES ('rebuild')")
+            print("  search index: rebuilt ({0})".format(e))
+
+        curs.execute("INSERT INTO task_fts (task_fts) VALUES ('optimize')")
+        conn.commit()
+
+    if problems:
+        for problem in problems:
+            print("    {0}".format(problem))
+
+        print_error("Qtask: ERROR: the database failed its integrity check.  Please restore it from a backup.")
+
+    curs.execute("PRAGMA analysis_limit = {0:d}".format(MAINTAIN_ANALYSIS_LIMIT))
+    curs.execute("ANALYZE")
+    curs.execute("PRAGMA optimize")
+    print("  query planner statistics: updated")
+
+    curs.execute("PRAGMA auto_vacuum")
+    auto_vacuum = curs.fetchone()[0]
+    curs.execute("PRAGMA freelist_count")
+    free_pages = curs.fetchone()[0]
+
+    if full:
+        # rewrites the whole file, which also switches on incremental vacuuming for DBs created
+        # before it was the default.  Readers carry on, but writers wait until it's done.
+        curs.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        curs.execute("VACUUM")
+        print("  vacuum: rebuilt the database file, freeing {0} pages".format(free_pages))
+    elif auto_vacuum == 2:
+        curs.execute("PRAGMA incremental_vacuum")
+        curs.fetchall()
+        print("  incremental vacuum: freed {0} pages".format(free_pages))
+    else:
+        print("  vacuum: skipped, this DB was created without incremental vacuum.  Run 'qtask maintain full' once to enable it.")
+
+    # a passive checkpoint copies what it can without waiting on (or blocking) anyone else
+    curs.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    (busy, wal_pages, checkpointed_pages) = curs.fetchone()
+    if wal_pages >= 0:
+        print("  checkpoint: {0} of {1} write-ahead log pages copied into the DB".format(checkpointed_pages, wal_pages))
+
+    print_db_statistics(curs, db_path)
+
+
+def print_db_statistics(curs, db_path):
+    curs.execute("PRAGMA page_size")
+    page_size = curs.fetchone()[0]
+    curs.execute("PRAGMA page_count")
+    page_count = curs.fetchone()[0]
+    curs.execute("PRAGMA freelist_count")
+    free_pages = curs.fetchone()[0]
+
+    wal_path = db_path + '-wal'
+
+    print("\n# Database statistics\n# -------------------")
+    print("file size\t{0}".format(get_size_string(os.path.getsize(db_path))))
+    if os.path.exists(wal_path):
+        print("write-ahead log size\t{0}".format(get_size_string(os.path.getsize(wal_path))))
+
+    print("page size\t{0} bytes".format(page_size))
+    print("pages\t{0}".format(page_count))
+    print("free pages\t{0}".format(free_pages))
+
+    for table in MAINTAIN_COUNTED_TABLES:
+        curs.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,) )
+        if curs.fetchone() is None:
+            continue
+
+        curs.execute("SELECT COUNT(*) FROM {0}".format(table))
+        print("{0} rows\t{1}".format(table, curs.fetchone()[0]))
+
+    archive_years = get_archive_years(curs)
+    if archive_years:
+        archive_size = sum([os.path.getsize(get_archive_path(db_path, year)) for year in archive_years])
+        print("archives\t{0} ({1}-{2}), {3}".format(len(archive_years), archive_years[0], archive_years[-1],
+                                                    get_size_string(archive_size)))
+
+
+def get_size_string(byte_count):
+    if byte_count < 1024:
+        return "{0} bytes".format(byte_count)
+
+    for unit in ('KiB', 'MiB', 'GiB'):
+        byte_count /= 1024
+        if byte_count < 1024 or unit == 'GiB':
+            return "{0:.1f} {1}".format(byte_count, unit)
+
+
+def process_sync_command(curs, args, **connect_args):
+    """
+    Merges another qtask database and this one both ways, so that afterwards both hold the same
+    projects, tasks and time.  Only what changed since the two last synced is exchanged.
+    """
+    # qtask sync ~/laptop.qtask.db
+    if len(args) != 2:
+        print_error("Usage: qtask sync <other.db>")
+
+    if curs.connection.in_transaction:
+        print_error("Qtask: Sorry, sync can't be run as part of a batch or shell session")
+
+    peer_path = os.path.abspath(args[1])
+    if peer_path == get_connected_db_path(curs):
+        print_error("Qtask: Sorry, a database can't be synced with itself")
+
+    # bring the other database up to this schema first
+    connect_db(peer_path, **connect_args).close()
+
+    curs.execute("ATTACH DATABASE ? AS peer", (peer_path,) )
+    try:
+        curs.execute("""SELECT m.value, p.value
+                          FROM main.qtask_meta m, peer.qtask_meta p
+                         WHERE m.key = 'db_uuid' AND p.key = 'db_uuid'""")
+        (db_uuid, peer_uuid) = curs.fetchone()
+
+        if db_uuid == peer_uuid:
+            print_error("Qtask: Sorry, {0} is a copy of this database, so time logged in each can't be told apart.  " \
+                        "Please sync with a database started with 'qtask init' instead.".format(args[1]))
+
+        # SQLite doesn't commit a transaction which writes to two files in WAL mode atomically, so
+        # each direction is a transaction of its own which only writes the receiving database.
+        (received_tasks, received_times) = pull_db_changes(curs, 'peer', 'main', peer_uuid, db_uuid)
+        (sent_tasks, sent_times) = pull_db_changes(curs, 'main', 'peer', db_uuid, peer_uuid)
+
+    finally:
+        curs.execute("DETACH DATABASE peer")
+
+    print("Qtask: synced with {0}: received {1} new tasks and time on {2}, sent {3} new tasks and time on {4}".format(
+        args[1], received_tasks, received_times, sent_tasks, sent_times))
+
+
+def pull_db_changes(curs, source, target, source_uuid, target_uuid):
+    """
+    Merges what changed in the source schema since the target last pulled from it into the
+    target, and records how far it got in the target's sync_state as part of the same
+    transaction.  Only the target is written, so if qtask stops part way through, the next sync
+    simply merges the same changes again.  Returns the counts from merge_db_changes().
+    """
+    params = {'source': source, 'target': target}
+
+    try:
+        curs.execute("BEGIN IMMEDIATE")
+
+        curs.execute("SELECT pulled FROM {target}.sync_state WHERE peer_uuid = ?".format(**params), (source_uuid,) )
+        row = curs.fetchone()
+        pulled = row[0] if row else 0
+
+        # How far the source has got with the target comes from the source's own record, so it's
+        # only ever what the source actually kept.  It's kept here as 'pushed' for reference.
+        curs.execute("SELECT pulled FROM {source}.sync_state WHERE peer_uuid = ?".format(**params), (target_uuid,) )
+        row = curs.fetchone()
+        pushed = row[0] if row else 0
+
+        # the source isn't written here, so this is everything the merge below brings across
+        curs.execute("SELECT value FROM {source}.qtask_meta WHERE key = 'change_counter'".format(**params))
+        source_counter = curs.fetchone()[0]
+
+        counts = merge_db_changes(curs, source, target, pulled)
+
+        curs.execute("INSERT OR REPLACE INTO {target}.sync_state (peer_uuid, pulled, pushed) VALUES (?, ?, ?)".format(**params),
+                     (source_uuid, source_counter, pushed) )
+        curs.connection.commit()
+
+    except BaseException:
+        curs.connection.rollback()
+        raise
+
+    return counts
+
+
+def merge_db_changes(curs, source, target, since):
+    """
+    Copies the projects and tasks changed in the source schema after change counter 'since'
+    into the target one.  Projects are matched by label, tasks by uuid, and time by taking the
+    larger of each database's count for a task.  Returns the number of tasks added and of tasks
+    whose time changed.
+    """
+    params = {'source': source, 'target': target}
+    curs.execute("INSERT OR REPLACE INTO {target}.qtask_meta (key, value) VALUES ('syncing', 1)".format(**params))
+
+    curs.execute('''INSERT INTO {target}.project (label, time_added)
+                        SELECT label, time_added
+                          FROM {source}.project
+                         WHERE modified > ?
+                               AND label NOT IN (SELECT label FROM {target}.project)
+                      ORDER BY id'''.format(**params), (since,) )
+
+    # work from before what the target has archived stays out of it
+    curs.execute("SELECT value FROM {target}.qtask_meta WHERE key = 'archived_before'".format(**params))
+    row = curs.fetchone()
+    archived_before = row[0] if row else None
+
+    curs.execute("SELECT MAX(id) FROM {target}.task".format(**params))
+    last_id = curs.fetchone()[0] or 0
+
+    curs.execute('''INSERT INTO {target}.task (uuid, label, time_added, time_added_epoch, project_id)
+                        SELECT s.uuid, s.label, s.time_added, s.time_added_epoch,
+                               (SELECT id FROM {target}.project tp WHERE tp.label = sp.label)
+                          FROM {source}.task s
+                               LEFT JOIN {source}.project sp ON s.project_id=sp.id
+                         WHERE s.modified > ?
+                               AND s.uuid NOT IN (SELECT uuid FROM {target}.task)
+                               AND (? IS NULL OR s.time_added_epoch IS NULL OR s.time_added_epoch >= ?)
+                      ORDER BY s.id'''.format(**params), (since, archived_before, archived_before) )
+    added_count = curs.rowcount
+
+    # parents may have arrived in the same batch, so subtasks are linked up once all are in
+    curs.execute('''UPDATE {target}.task
+                      SET parent_id = (SELECT tp.id
+                                         FROM {source}.task s
+                                              JOIN {source}.task sp ON s.parent_id=sp.id
+                                              JOIN {target}.task tp ON sp.uuid=tp.uuid
+                                        WHERE s.uuid = task.uuid)
+                    WHERE id > ?
+                          AND uuid IN (SELECT uuid FROM {source}.task WHERE modified > ? AND parent_id IS NOT NULL)'''.format(**params),
+                 (last_id, since) )
+
+    # CROSS JOIN keeps SQLite to this join order, starting from the few changed tasks.  When only
+    # one side has planner statistics it may otherwise scan every task in the target.
+    curs.execute('''INSERT INTO {target}.task_time (task_id, origin, minutes)
+                        SELECT tt.id, st.origin, st.minutes
+                          FROM {source}.task s
+                               CROSS JOIN {source}.task_time st ON st.task_id=s.id
+                               CROSS JOIN {target}.task tt ON s.uuid=tt.uuid
+                         WHERE s.modified > ?
+                   ON CONFLICT (task_id, origin) DO UPDATE SET minutes = MAX(minutes, excluded.minutes)'''.format(**params),
+                 (since,) )
+
+    curs.execute('''UPDATE {target}.task
+                      SET time_logged = (SELECT SUM(minutes) FROM {target}.task_time WHERE task_id = task.id)
+                    WHERE uuid IN (SELECT uuid FROM {source}.task WHERE modified > ?)
+                          AND time_logged IS NOT (SELECT SUM(minutes) FROM {target}.task_time WHERE task_id = task.id)'''.format(**params),
+                 (since,) )
+    changed_count = curs.rowcount
+
+    curs.execute("DELETE FROM {target}.qtask_meta WHERE key = 'syncing'".format(**params))
+
+    return (added_count, changed_count)
+
+
+def process_batch_command(store, args, parser, commit_interval=None):
+    """
+    Runs many qtask commands, one per line, on this one connection.  'batch' reads them from a
+    file or STDIN and 'shell' prompts for them interactively.  Lines use shell-style quoting and
+    may optionally start with 'qtask'.  A line which fails is reported and rolled back on its own
+    without ending the session.  Returns 1 if any line failed, else 0.
+    """
+    command = args.pop(0)
+    interactive = (command == 'shell')
+
+    if commit_interval is None:
+        commit_interval = 1 if interactive else BATCH_COMMIT_INTERVAL
+
+    if interactive:
+        if len(args) > 0:
+            print_error("Usage: qtask shell")
+
+        try:
+            import readline
+        except ImportError:
+            pass
+
+        lines = read_shell_lines()
+    elif len(args) == 0 or args[0] == '-':
+        lines = sys.stdin
+    elif len(args) == 1:
+        try:
+            lines = open(args[0])
+        except OSError as e:
+            print_error("Qtask: ERROR: couldn't open batch file {0}: {1}".format(args[0], e))
+    else:
+        print_error("Usage: qtask batch <file|->")
+
+    import shlex
+
+    conn = store.conn
+    curs = store.curs
+    command_count = 0
+    failed_count = 0
+    uncommitted_count = 0
+
+    for line in lines:
+        try:
+            tokens = shlex.split(line, comments=True)
+        except ValueError as e:
+            print("Qtask: ERROR: couldn't parse line: {0}".format(e))
+            command_count += 1
+            failed_count += 1
+            continue
+
+        if len(tokens) > 0 and tokens[0] == 'qtask':
+            tokens.pop(0)
+
+        if len(tokens) == 0:
+            continue
+
+        if interactive and tokens[0] in ('exit', 'quit'):
+            break
+
+        command_count += 1
+
+        # Each line gets its own savepoint so a failure only undoes that line.  The write lock is
+        # taken up front, so a line which reads before writing waits out other writers via the
+        # busy timeout rather than failing when it comes to write.
+        if not conn.in_transaction:
+            curs.execute("BEGIN IMMEDIATE")
+        curs.execute("SAVEPOINT batch_line")
+
+        try:
+            if tokens[0] in ('batch', 'init', 'serve', 'shell'):
+                print_error("Qtask: the {0} command can't be run inside a batch or shell session".format(tokens[0]))
+
+            run_command(store, parser.parse_args(tokens))
+            curs.execute("RELEASE batch_line")
+            uncommitted_count += 1
+
+        except (Exception, SystemExit) as e:
+            # SystemExit comes from argparse, which has already printed its own usage message
+            if not isinstance(e, SystemExit):
+                print(e if isinstance(e, QtaskError) else "Qtask: ERROR: {0}".format(e))
+
+            failed_count += 1
+            curs.execute("ROLLBACK TO batch_line")
+            curs.execute("RELEASE batch_line")
+
+            # the line may have added a project which no longer exists
+            store.project_ids.clear()
+
+        # Committing with nothing pending still ends the transaction, so the write lock isn't
+        # held after a failed line, e.g. while a shell waits at its prompt.
+        if uncommitted_count == 0 or uncommitted_count >= commit_interval:
+            store.commit()
+            uncommitted_count = 0
+
+    store.commit()
+
+    if lines is not sys.stdin and not interactive:
+        lines.close()
+
+    if not interactive:
+        print("Qtask: batch ran {0} commands ({1} failed)".format(command_count, failed_count))
+
+    return 1 if failed_count > 0 else 0
+
+
+def read_shell_lines():
+    """
+    Generator of lines typed at the 'qtask shell' prompt, ending at EOF (Ctrl-D)
+    """
+    while True:
+        try:
+            yield input(SHELL_PROMPT)
+        except EOFError:
+            print()
+            return
+        except KeyboardInterrupt:
+            print()
+            continue
+
+
+def process_import_command(store, args, create_projects=False):
+    # get rid of the first argument, which was just the 'import' command
+    args.pop(0)
+    curs = store.curs
+    start_time = time.time()
+
+    if len(args) == 0 or args[0] == '-':
+        source_name = 'STDIN'
+        fh = sys.stdin
+    else:
+        source_name = args[0]
+        try:
+            fh = open(source_name, newline='')
+        except OSError as e:
+            print_error("Qtask: ERROR: couldn't open import file {0}: {1}".format(source_name, e))
+
+    now = "{0}".format(datetime.datetime.now())
+
+    if not curs.connection.in_transaction:
+        curs.execute("BEGIN IMMEDIATE")
+
+    row_count = 0
+    skipped_count = 0
+    pending = list()
+
+    for (line_num, row) in read_import_rows(fh, source_name):
+        try:
+            if isinstance(row, ValueError):
+                raise row
+
+            label = row.get('label')
+            if label is None or str(label).strip() == '':
+                raise ValueError("a task label is required")
+
+            project_id = None
+            project_label = row.get('project')
+            if project_label is not None and project_label != '':
+                # looked up once per label, as the store caches project IDs
+                project_id = store.get_project_id(project_label)
+
+                if project_id is None:
+                    if not create_projects:
+                        raise ValueError("project '{0}' not found (see --create_projects)".format(project_label))
+                    elif project_label in PROJECT_RESERVED_WORDS:
+                        raise ValueError("the word '{0}' is reserved and can't be used for a project name".format(project_label))
+
+                    project_id = process_add_command(store, 'project', project_label)
+
+            time_added = row.get('time_added')
+            if time_added is None or time_added == '':
+                time_added = now
+
+            time_added_epoch = get_epoch(str(time_added))
+            if time_added_epoch is None:
+                raise ValueError("couldn't understand the date '{0}'".format(time_added))
+
+            time_logged = row.get('time_logged')
+            if time_logged is None or time_logged == '':
+                time_logged = None
+            else:
+                time_logged = float(time_logged)
+                if time_logged.is_integer():
+                    time_logged = int(time_logged)
+
+        except ValueError as e:
+            skipped_count += 1
+            print("Qtask: skipping {0} row {1}: {2}".format(source_name, line_num, e))
+            continue
+
+        pending.append((line_num, (label, str(time_added), time_added_epoch, time_logged, project_id)))
+
+        if len(pending) >= IMPORT_CHUNK_SIZE:
+            inserted = insert_import_chunk(curs, pending, source_name)
+            row_count += inserted
+            skipped_count += len(pending) - inserted
+            pending = list()
+
+    if pending:
+        inserted = insert_import_chunk(curs, pending, source_name)
+        row_count += inserted
+        skipped_count += len(pending) - inserted
+
+    if fh is not sys.stdin:
+        fh.close()
+
+    elapsed = time.time() - start_time
+    rate = row_count / elapsed if elapsed > 0 else row_count
+    print("Qtask: imported {0} tasks from {1} ({2} skipped) in {3:.2f} seconds ({4:.0f} rows/sec)".format(
+        row_count, source_name, skipped_count, elapsed, rate))
+
 
-        """)
+def insert_import_chunk(curs, pending, source_name):
+    """
+    Inserts a chunk of parsed import rows with a single executemany() call.  If the
+    database rejects any row the chunk is rolled back to its savepoint and retried one
+    row at a time so only the offending rows are skipped.  Returns the number inserted.
+    """
+    qry_str = "INSERT INTO task (label, time_added, time_added_epoch, time_logged, project_id) VALUES (?, ?, ?, ?, ?)"
 
-    elif cmd == 'report':
-        print("""
-        Qtask help command: report
-        
-        The 'report' command is used group and display work logged by project over a given time
-        interval.
+    curs.execute("SAVEPOINT import_chunk")
+    try:
+        curs.executemany(qry_str, [values for (line_num, values) in pending])
+        curs.execute("RELEASE import_chunk")
+        return len(pending)
+    except sqlite3.DatabaseError:
+        curs.execute("ROLLBACK TO import_chunk")
 
-        Example usage:
+    inserted = 0
+    for (line_num, values) in pending:
+        try:
+            curs.execute(qry_str, values)
+            inserted += 1
+        except sqlite3.DatabaseError as e:
+            print("Qtask: skipping {0} row {1}: {2}".format(source_name, line_num, e))
 
-            qtask report work in last 30 days
-            qtask report work in last 1 week
-        
-        """)
-        
+    curs.execute("RELEASE import_chunk")
+    return inserted
+
+
+def read_import_rows(fh, source_name):
+    """
+    Generator yielding (line number, dict) pairs from a CSV or JSONL stream.  The format
+    is taken from the file extension when there is one, else sniffed from the first line.
+    """
+    first_line = fh.readline()
+    if first_line == '':
+        return
+
+    if source_name.endswith('.jsonl') or source_name.endswith('.json'):
+        is_jsonl = True
+    elif source_name.endswith('.csv'):
+        is_jsonl = False
     else:
-        print_error("Qtask: Sorry, help for the command ({0}) is not yet implemented".format(cmd))
+        is_jsonl = first_line.lstrip().startswith('{')
 
-        
-def process_add_command(curs, item_type, label):
-    print("Attempting to insert project: {0}".format(label))
-    now = "{0}".format(datetime.datetime.now())
-    
-    # parsing wouldn't work if any of these words were used as a project name
-    project_reserved_words = ['work']
-    
-    if item_type == 'project':
-        if label in project_reserved_words:
-            print_error("Qtask: Sorry, the word '{0}' is reserved and can't be used for a project name.".format(label))
-        
-        curs.execute("INSERT INTO project (label, time_added) VALUES (?, ?)", (label, now) )
-        row_id = curs.lastrowid
-        print("Qtask: Project '{0}' added to the database with id={1}".format(label, row_id))
-        return row_id
+    if is_jsonl:
+        import json
+
+        line_num = 0
+        for line in itertools.chain([first_line], fh):
+            line_num += 1
+            if line.strip() == '':
+                continue
+
+            # parse failures are handed back to the caller so they're counted as skipped rows
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield (line_num, e)
+                continue
+
+            if not isinstance(row, dict):
+                yield (line_num, ValueError("expected a JSON object"))
+                continue
+
+            yield (line_num, row)
     else:
-        print_error("Qtask: Sorry, there is currently only support for adding projects")
+        import csv
+
+        reader = csv.DictReader(itertools.chain([first_line], fh))
+        for row in reader:
+            yield (reader.line_num, row)
 
-def process_list_command(curs, args):
+
+def process_list_command(store, args, output_format='text', limit=None, after=None):
     # get rid of the first argument, which was just the 'list' command
     command = args.pop(0)
-    now = datetime.datetime.now()
+    curs = store.curs
 
     if command == 'list':
         grouping = None
@@ -322,10 +2726,36 @@ def process_list_command(curs, args):
     else:
         raise Exception("Qtask:  Internal error:  process_list_command() called with command other than list or report.")
 
+    if grouping is not None and (limit is not None or after is not None):
+        print_error("Qtask: Sorry, --limit and --after can only be used when listing work, not with reports")
+
+    # Totals reports are served from the rollup table rather than the tasks themselves:
+    #  qtask report totals in last 52 weeks
+    #  qtask report totals by week in last 52 weeks
+    if grouping == 'project' and args[0] == 'totals':
+        args.pop(0)
+        bucket = None
+        if len(args) >= 2 and args[0] == 'by':
+            if args[1] not in ('day', 'week'):
+                print_error("Qtask: Sorry, totals can only be reported by day or by week")
+
+            bucket = args[1]
+            args = args[2:]
+
+        (from_date, until_date) = (None, None)
+        if args:
+            (from_date, until_date) = get_date_range(args)
+
+        list_totals(curs, bucket=bucket, from_date=from_date, until=until_date, output_format=output_format)
+
     # There are several different ways to call this.
     # 1 argument: Currently only supports direct lists of 'projects' or 'work'
-    if len(args) == 1:
-        if args[0] == 'projects':
+    elif len(args) == 1:
+        if args[0] == 'projects' and output_format != 'text':
+            curs.execute('''SELECT id, label, strftime('%Y-%m-%dT%H:%M:%S', time_added) FROM project ORDER BY label''' )
+            write_rows(curs, ['id', 'label', 'time_added'], output_format)
+
+        elif args[0] == 'projects':
             curs.execute('''SELECT id, label, time_added FROM project ORDER BY LABEL''' )
             project_count = 0
 
@@ -338,7 +2768,7 @@ def process_list_command(curs, args):
                 print("#- No projects found -#")
             
         elif args[0] == 'work':
-            list_tasks(curs, group_by=grouping)
+            list_tasks(curs, group_by=grouping, output_format=output_format, limit=limit, after=after)
 
         else:
             print_error("Qtask: Sorry, I don't know how to list {0}".format(args[0]))
@@ -348,26 +2778,31 @@ def process_list_command(curs, args):
     elif len(args) == 2:
         # if the 2nd term is 'work' the first is assumed to be the project
         if args[1] == 'work':
-            project_id = get_project_id_by_label(curs, args[0])
+            project_id = store.get_project_id(args[0])
             if project_id is None:
                 print_error("Qtask.  Couldn't list work in project {0} because the project wasn't found.".format(args[0]))
             else:
-                list_tasks(curs, project_id=project_id, group_by=grouping)
+                list_tasks(curs, project_id=project_id, group_by=grouping, output_format=output_format, limit=limit, after=after)
 
         # if the 1st term is 'work' the following is chronological description.  E.g:
         #  qtask list work today
         elif args[0] == 'work':
-            if args[1] == 'today':
-                from_date = "{0} 00:00:00".format(datetime.date.today())
-                until_date = "{0}".format(datetime.datetime.now())
-                list_tasks(curs, from_date=from_date, until=until_date, group_by=grouping)
-            elif args[1] == 'yesterday':
-                delta = get_delta(1, 'day')
-                from_date = "{0} 00:00:00".format(datetime.date.today() - delta)
-                until_date = "{0} 23:59:59".format(datetime.date.today() - delta)
-                list_tasks(curs, from_date=from_date, until=until_date, group_by=grouping)
+            (from_date, until_date) = get_date_range(args[1:])
+            list_tasks(curs, from_date=from_date, until=until_date, group_by=grouping, output_format=output_format, limit=limit, after=after)
+
+        # a task and all its subtasks, e.g.:
+        #  qtask list task 231
+        #  qtask report task 231
+        elif args[0] == 'task':
+            # trees are drawn for people, and there's no table of rows to give other programs
+            if output_format != 'text':
+                print_error("Qtask: Sorry, --format can't be used when listing or reporting a task and its subtasks")
+
+            task_id = get_task_id(curs, args[1])
+            if grouping == 'project':
+                report_task_total(curs, task_id)
             else:
-                print_error("Qtask: Sorry, I couldn't recognize your list syntax. Please see the examples and try again")
+                list_task_tree(curs, task_id)
         else:
             print_error("Qtask: Sorry, I couldn't recognize your list syntax. Please see the examples and try again")
 
@@ -376,126 +2811,942 @@ def process_list_command(curs, args):
     #  qtask list work in last 1 week
     #  qtask list work between 2015-02-10 and 2015-02-17
     elif len(args) == 5:
-        if args[1] == 'in' and args[2] == 'last':
-            delta = get_delta(int(args[3]), args[4])
-
-            if delta == None:
-                print_error("Qtask: Sorry, I couldn't recognize your list syntax. Please see the examples and try again")
-            
-            list_tasks(curs, from_date="{0}".format(now - delta), until=str(now), group_by=grouping)
-
-        
-        elif args[1] == 'between' and args[3] == 'and':
-            from_date = "{0}".format(args[2])
-            until_date = "{0}".format(args[4])
-            list_tasks(curs, from_date=from_date, until=until_date, group_by=grouping)
+        if args[0] == 'work':
+            (from_date, until_date) = get_date_range(args[1:])
+            list_tasks(curs, from_date=from_date, until=until_date, group_by=grouping, output_format=output_format, limit=limit, after=after)
         else:
             print_error("Qtask: Sorry, I couldn't recognize your list syntax. Please see the examples and try again")
 
     # examples of six arguments
     #  qtask list Annotation work in last 2 weeks
+    #  qtask list Annotation work between 2015-02-10 and 2015-02-17
     elif len(args) == 6:
-        project_id = get_project_id_by_label(curs, args[0])
+        if args[1] != 'work':
+            print_error("Qtask: Sorry, I couldn't recognize your list syntax. Please see the examples and try again")
+
+        project_id = store.get_project_id(args[0])
         if project_id is None:
             print_error("Qtask.  Couldn't list work in project {0} because the project wasn't found.".format(args[0]))
 
-        if args[2] == 'in' and args[3] == 'last':
-            delta = get_delta(int(args[4]), args[5])
+        (from_date, until_date) = get_date_range(args[2:])
+        list_tasks(curs, project_id=project_id, from_date=from_date, until=until_date, group_by=grouping, output_format=output_format, limit=limit, after=after)
 
-            if delta == None:
-                print_error("Qtask: Sorry, I couldn't recognize your list syntax. Please see the examples and try again")
-            
-            list_tasks(curs, project_id=project_id, from_date="{0}".format(now - delta), until=str(now), group_by=grouping)
+    else:
+        print_error("Qtask: Sorry, I couldn't recognize your list syntax. Please see the examples and try again")
 
-        
-        elif args[1] == 'between' and args[3] == 'and':
-            from_date = "{0}".format(args[3])
-            until_date = "{0}".format(args[5])
-            list_tasks(curs, project_id=project_id, from_date=from_date, until=until_date, group_by=grouping)
-        else:
-            print_error("Qtask: Sorry, I couldn't recognize your list syntax. Please see the examples and try again")
 
+def process_team_report_command(file_paths, args, output_format='text', limit=None, after=None):
+    """
+    Reports work logged across several people's DB files as one, grouped by project with a
+    breakdown by person.  Each file is read by a thread of its own on a read-only connection,
+    and their already sorted results are merged as they arrive.  A reader waits once it's
+    TEAM_REPORT_QUEUE_SIZE batches ahead, so memory use doesn't grow with the size of the files.
+    """
+    # qtask -d team/ report work in last 4 weeks
+    # qtask -d alice.db -d bob.db report Annotation work between 2015-02-10 and 2015-02-17
+    args = args[1:]
+    project_label = None
+
+    if limit is not None or after is not None:
+        print_error("Qtask: Sorry, --limit and --after can only be used when listing work, not with reports")
+
+    if len(args) >= 2 and args[1] == 'work':
+        project_label = args.pop(0)
+
+    if not args or args[0] != 'work':
+        print_error("Qtask: Sorry, only 'report [<project>] work [<date range>]' can be run on more than one DB file")
+
+    (from_date, until_date) = (None, None)
+    if len(args) > 1:
+        (from_date, until_date) = get_date_range(args[1:])
+
+    qry_str = '''
+        SELECT COALESCE(p.label, 'Other (no project)'), t.time_added_epoch, t.id, p.label, t.time_added,
+               strftime('%Y-%m-%dT%H:%M:%S', t.time_added_epoch, 'unixepoch'), t.time_logged, t.label
+          FROM {tasks} t
+               LEFT JOIN {projects} p ON t.project_id=p.id
+         WHERE 1
+    '''
+    qry_args = list()
+
+    if project_label is not None:
+        qry_str += " AND p.label = ? "
+        qry_args.append(project_label)
+
+    if from_date is not None:
+        qry_str += " AND t.time_added_epoch >= ? "
+        qry_args.append(from_date)
+
+    if until_date is not None:
+        qry_str += " AND t.time_added_epoch < ? "
+        qry_args.append(until_date)
+
+    # the same order every file's rows are merged in: by project, then most recent first
+    qry_str += " ORDER BY COALESCE(p.label, 'Other (no project)'), t.time_added_epoch DESC, t.id DESC "
+    merge_key = lambda row: (row[0], -row[1] if row[1] is not None else float('inf'))
+
+    import concurrent.futures
+    import heapq
+    import queue
+    import threading
+
+    # SQLite lets go of the GIL while it works, so threads are enough to keep every core busy.
+    # The merge needs the next rows of every file, so each gets a thread rather than waiting
+    # for a free one.
+    queues = [queue.Queue(maxsize=TEAM_REPORT_QUEUE_SIZE) for file_path in file_paths]
+    stopped = threading.Event()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(file_paths)) as pool:
+        for (file_path, rows_queue) in zip(file_paths, queues):
+            pool.submit(read_team_report_rows, file_path, qry_str, qry_args, from_date, until_date, rows_queue, stopped)
+
+        try:
+            rows = heapq.merge(*[iter_team_report_rows(get_person_name(file_path), rows_queue)
+                                 for (file_path, rows_queue) in zip(file_paths, queues)], key=merge_key)
+
+            if output_format != 'text':
+                columns = ['person', 'id', 'project_label', 'time_added', 'time_logged', 'label']
+                write_rows(((row[2], row[3], row[4], row[6], row[7], row[8]) for row in rows), columns, output_format)
+                return
+
+            print_team_report(rows, len(file_paths))
+
+        finally:
+            # lets any reader still waiting on a full queue give up, so the pool can shut down
+            stopped.set()
+
+
+def read_team_report_rows(file_path, qry_str, qry_args, from_date, until_date, rows_queue, stopped):
+    """
+    Runs a team report's query against one DB file, putting its rows on the queue a batch at a
+    time and then None.  Any error is put on the queue in place of the rows.  It stops early
+    once the 'stopped' event is set.
+    """
+    conn = None
+    try:
+        conn = sqlite3.connect(get_read_only_uri(file_path), uri=True)
+        curs = conn.cursor()
+
+        # a read-only connection can't upgrade the schema, and reports need the epoch column
+        curs.execute("PRAGMA user_version")
+        if curs.fetchone()[0] < 1:
+            print_error("Qtask: Sorry, {0} was made by an older version of qtask.  Please run any qtask " \
+                        "command on it to upgrade it first".format(file_path))
+
+        rows = iter_task_query(curs, qry_str, qry_args, get_archive_years(curs, from_date, until_date), newest_first=False)
+
+        while True:
+            chunk = list(itertools.islice(rows, REPORT_FETCH_SIZE))
+            if not chunk or not put_team_report_rows(rows_queue, chunk, stopped):
+                break
+
+    except Exception as e:
+        if isinstance(e, sqlite3.Error):
+            e = QtaskError("Qtask: Sorry, couldn't read {0}: {1}".format(file_path, e))
+
+        put_team_report_rows(rows_queue, e, stopped)
+
+    finally:
+        put_team_report_rows(rows_queue, None, stopped)
+        if conn is not None:
+            conn.close()
+
+
+def put_team_report_rows(rows_queue, rows, stopped):
+    """
+    Puts rows on a team report reader's queue, waiting while it's full.  Returns False without
+    putting them if the report stops reading first.
+    """
+    import queue
+
+    while not stopped.is_set():
+        try:
+            rows_queue.put(rows, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+
+    return False
+
+
+def iter_team_report_rows(person, rows_queue):
+    while True:
+        rows = rows_queue.get()
+        if rows is None:
+            return
+
+        if isinstance(rows, Exception):
+            raise rows
+
+        for row in rows:
+            yield row[:2] + (person,) + row[2:]
+
+
+def get_person_name(file_path):
+    """
+    Names the person a team report's DB file belongs to after the file, e.g. 'alice' for
+    team/alice.qtask.db
+    """
+    name = os.path.basename(file_path)
+
+    for suffix in ('.qtask.db', '.db'):
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+
+    return name.lstrip('.') or file_path
+
+
+def print_team_report(rows, file_count):
+    title = "Work logged in {0} DB files".format(file_count)
+    print("# {0}\n# {1}".format(title, '-' * len(title)))
+
+    current_project = None
+    project_minutes = dict()
+    person_minutes = dict()
+    work_count = 0
+
+    for (project_name, epoch, person, task_id, raw_label, time_added, time_added_iso, time_logged, task_label) in rows:
+        work_count += 1
+
+        if project_name != current_project:
+            if current_project is not None:
+                print_person_totals(project_minutes)
+
+            current_project = project_name
+            project_minutes = dict()
+            print("\n{0}\n{1}".format(project_name, '-' * len(project_name)))
+
+        project_minutes[person] = project_minutes.get(person, 0) + (time_logged or 0)
+        person_minutes[person] = person_minutes.get(person, 0) + (time_logged or 0)
+
+        print("{0}\t{1}\t{2}\t{3}\t{4}".format(person, task_id, time_added.split('.')[0], time_logged_string(time_logged), task_label))
+
+    if work_count == 0:
+        print("#- No work logged -#")
+        return
+
+    print_person_totals(project_minutes)
+
+    print("\nEveryone\n--------")
+    print_person_totals(person_minutes)
+
+
+def print_person_totals(person_minutes):
+    print_project_total(sum(person_minutes.values()))
+
+    for person in sorted(person_minutes):
+        print("  {0}:\t{1}".format(person, time_logged_string(person_minutes[person])))
+
+
+def process_search_command(store, args, output_format='text', limit=None):
+    # get rid of the first argument, which was just the 'search' command
+    args.pop(0)
+    curs = store.curs
+
+    if len(args) == 0:
+        print_error("Usage: qtask search <terms> [in <project>] [<date range>].  Please see help for more examples")
+
+    match_query = args.pop(0)
+    project_id = None
+
+    #  qtask search bowtie in Annotation ...
+    # Date ranges are one or four words, so 'in <project>' leaves two, three or six, while
+    # 'in last 2 weeks' alone is four.  That way a project can even be called 'last'.
+    if len(args) in (2, 3, 6) and args[0] == 'in':
+        project_id = store.get_project_id(args[1])
+        if project_id is None:
+            print_error("Qtask.  Couldn't search work in project {0} because the project wasn't found.".format(args[1]))
+
+        args = args[2:]
+
+    (from_date, until_date) = (None, None)
+    if args:
+        (from_date, until_date) = get_date_range(args)
+
+    check_limit(limit)
+    if limit is None:
+        limit = SEARCH_DEFAULT_LIMIT
+
+    qry_args = [match_query]
+    if output_format == 'text':
+        qry_str = '''
+    SELECT t.id, t.label AS task_label, t.time_added, t.time_logged, p.label AS project_name
+    '''
     else:
-        print_error("Qtask: Sorry, I couldn't recognize your list syntax. Please see the examples and try again")
+        # the same columns as 'list work' gives other programs, best matches first
+        columns = ['id', 'parent_id', 'project_id', 'project_label', 'time_added', 'time_logged', 'label']
+        qry_str = '''
+    SELECT t.id, t.parent_id, t.project_id, p.label,
+           strftime('%Y-%m-%dT%H:%M:%S', t.time_added_epoch, 'unixepoch'), t.time_logged, t.label
+    '''
+
+    qry_str += '''
+      FROM task_fts
+           JOIN task t ON t.id=task_fts.rowid
+           LEFT JOIN project p ON t.project_id=p.id
+     WHERE task_fts MATCH ?
+    '''
+    if project_id is not None:
+        qry_str += " AND t.project_id = ? "
+        qry_args.append(project_id)
 
+    if from_date is not None:
+        qry_str += " AND t.time_added_epoch >= ? "
+        qry_args.append(from_date)
+
+    if until_date is not None:
+        qry_str += " AND t.time_added_epoch < ? "
+        qry_args.append(until_date)
+
+    qry_str += " ORDER BY task_fts.rank LIMIT ? "
+    qry_args.append(limit)
+
+    try:
+        curs.execute(qry_str, qry_args)
+        rows = curs.fetchall()
+    except sqlite3.OperationalError as e:
+        if 'no such table' in str(e):
+            print_error("Qtask: Sorry, search isn't available because this SQLite library doesn't include FTS5")
+
+        print_error("Qtask: Sorry, I couldn't understand the search '{0}': {1}".format(match_query, e))
+
+    if output_format != 'text':
+        write_rows(iter(rows), columns, output_format)
+        return
+
+    print("# Search results\n# --------------")
 
-def process_log_command(curs, args):
+    for (task_id, task_label, time_added, time_logged, project_name) in rows:
+        print("{0}\t{1}\t{2}\t{3}\t{4}".format(task_id, project_name, time_added.split('.')[0],
+                                                time_logged_string(time_logged), task_label))
+
+    if len(rows) == 0:
+        print("#- No matching work found -#")
+
+
+def process_log_command(store, args):
     # get rid of the first argument, which was just the 'log' command
     args.pop(0)
-    now = "{0}".format(datetime.datetime.now())
     
     # There are several different ways to call this.
     # 1 argument:  Must be a label only, no project association
     if len(args) == 1:
-        curs.execute("INSERT INTO task (label, time_added) VALUES (?, ?)", (args[0], now) )
-        print("Qtask: task id:{0} logged".format(curs.lastrowid))
+        task_id = store.log_task(args[0])
+        print("Qtask: task id:{0} logged".format(task_id))
 
     # 3 arguments:  <label> to <project>
     elif len(args) == 3 and args[1] == 'to':
-        project_label = args[2]
-        project_id = get_project_id_by_label(curs, project_label)
+        task_id = store.log_task(args[0], project=args[2])
+        print("Qtask: task id:{0} logged to project {1}".format(task_id, args[2]))
 
-        if project_id is None:
-            print_error("Qtask: ERROR: couldn't find project '{0}' to log work against".format(project_label))
-        else:
-            curs.execute("INSERT INTO task (label, time_added, project_id) VALUES (?, ?, ?)",
-                         (args[0], now, project_id) )
-            print("Qtask: task id:{0} logged to project {1}".format(curs.lastrowid, project_label))
+    # 4 arguments, like: "Ran the aligner" under task 231
+    # Subtasks are filed to the same project as their parent.
+    elif len(args) == 4 and args[1] == 'under' and args[2] == 'task':
+        task_id = store.log_task(args[0], parent_id=args[3])
+        print("Qtask: task id:{0} logged under task {1}".format(task_id, args[3]))
 
     # 3 arguments, like: "Submitted timesheets" on 2015-01-13
     elif len(args) == 3 and args[1] == 'on':
-        curs.execute("INSERT INTO task (label, time_added) VALUES (?, datetime(?))", (args[0],args[2]) )
-        print("Qtask: task id:{0} logged".format(curs.lastrowid))
+        task_id = store.log_task(args[0], time_added=args[2])
+        print("Qtask: task id:{0} logged".format(task_id))
             
     # 5 elements, like: 5 hours against task 231
     elif len(args) == 5 and args[2] == 'against' and args[3] == 'task':
         # convert the time passed to minutes
+        try:
+            amount = float(args[0])
+        except ValueError:
+            amount = None
+
+        if amount is None or not 0 < amount < float('inf'):
+            print_error("Sorry, '{0}' isn't an amount of time I understand.  Use a number like 30 or 1.5".format(args[0]))
+
         if args[1] == 'minutes':
-            time_to_add = int(args[0])
+            time_to_add = amount
         elif args[1] == 'hours':
-            time_to_add = int(args[0]) * 60
+            time_to_add = amount * 60
         else:
             print_error("Sorry, time can currently only be logged as minutes or hours")
 
-        # get the current time logged for the task
-        curs.execute('''SELECT time_logged FROM task WHERE id = ?''', (args[4],) )
-        row = curs.fetchone()
-        time_previously_logged = 0
-        if row:
-            if row[0] is not None:
-                time_previously_logged = row[0]
-        else:
-            print_error("Sorry, couldn't find a task with ID={0}".format(args[4]))
+        if time_to_add.is_integer():
+            time_to_add = int(time_to_add)
 
-        # increment it
-        curs.execute('''UPDATE task SET time_logged = ? WHERE id = ?''', (time_previously_logged + time_to_add, args[4]))
+        store.add_time(args[4], time_to_add)
 
     # 5 elements, like: "Created bowtie2 index of genomes" to Annotation on 2015-01-21
     elif len(args) == 5 and args[1] == 'to' and args[3] == 'on':
-        project_label = args[2]
-        project_id = get_project_id_by_label(curs, project_label)
-
-        if project_id is None:
-            print_error("Qtask: ERROR: couldn't find project '{0}' to log work against".format(project_label))
-        else:
-            curs.execute("INSERT INTO task (label, time_added, project_id) VALUES (?, ?, ?)",
-                         (args[0], args[4], project_id) )
-            print("Qtask: task id:{0} logged to project {1} on {2}".format(curs.lastrowid, project_label, args[4]))
+        task_id = store.log_task(args[0], project=args[2], time_added=args[4])
+        print("Qtask: task id:{0} logged to project {1} on {2}".format(task_id, args[2], args[4]))
 
     # 5 elements, like: "Created bowtie2 index of genomes" on 2015-01-21 to Annotation
     elif len(args) == 5 and args[3] == 'to' and args[1] == 'on':
-        project_label = args[4]
-        project_id = get_project_id_by_label(curs, project_label)
+        task_id = store.log_task(args[0], project=args[4], time_added=args[2])
+        print("Qtask: task id:{0} logged to project {1} on {2}".format(task_id, args[4], args[2]))
 
-        if project_id is None:
-            print_error("Qtask: ERROR: couldn't find project '{0}' to log work against".format(project_label))
+    else:
+        print_error("Qtask: I didn't understand your log command.  See 'qtask help log' for examples")
+
+
+def process_status_command(curs, args, output_format='text', status=None):
+    if len(args) != 1:
+        print_error("Usage: qtask status [--fast]")
+
+    print_status(status or get_status(curs), output_format=output_format)
+
+
+def get_status(curs):
+    """
+    Gathers the short summary shown by 'qtask status': time logged today, this week's time per
+    project (weeks start on Monday) and the last task logged.  Totals come from the rollup table.
+    """
+    today = get_epoch(datetime.datetime.now()) // 86400
+    week_start = today - ((today + 3) % 7)
+
+    curs.execute('''SELECT SUM(minutes), SUM(task_count) FROM daily_project_totals WHERE day = ?''', (today,) )
+    (today_minutes, today_tasks) = curs.fetchone()
+
+    curs.execute('''
+    SELECT COALESCE(p.label, 'Other (no project)'), SUM(d.task_count), SUM(d.minutes)
+      FROM daily_project_totals d
+           LEFT JOIN project p ON d.project_id=p.id
+     WHERE d.day >= ? AND d.day <= ?
+     GROUP BY d.project_id
+     ORDER BY 3 DESC, 1
+    ''', (week_start, today) )
+    week_projects = [{'label': label, 'tasks': task_count, 'minutes': minutes} for (label, task_count, minutes) in curs]
+
+    curs.execute('''
+    SELECT t.id, t.label, p.label, t.time_logged
+      FROM task t
+           LEFT JOIN project p ON t.project_id=p.id
+     ORDER BY t.id DESC LIMIT 1
+    ''')
+    row = curs.fetchone()
+    last_task = None if row is None else {'id': row[0], 'label': row[1], 'project': row[2], 'time_logged': row[3]}
+
+    return {
+        'date': str(datetime.date(1970, 1, 1) + datetime.timedelta(days=today)),
+        'today': {'minutes': today_minutes or 0, 'tasks': today_tasks or 0},
+        'week': {
+            'start': str(datetime.date(1970, 1, 1) + datetime.timedelta(days=week_start)),
+            'minutes': sum([project['minutes'] for project in week_projects]),
+            'projects': week_projects
+        },
+        'last_task': last_task
+    }
+
+
+def print_status(status, output_format='text'):
+    if output_format != 'text':
+        # one JSON object whatever the --format, as the parts don't fit in a single table
+        import json
+        print(json.dumps(status))
+        return
+
+    print("Today:\t{0}\t{1} tasks".format(time_logged_string(status['today']['minutes']), status['today']['tasks']))
+    print("This week:\t{0}\tsince {1}".format(time_logged_string(status['week']['minutes']), status['week']['start']))
+
+    for project in status['week']['projects']:
+        print("\t{0}\t{1} tasks\t{2}".format(time_logged_string(project['minutes']), project['tasks'], project['label']))
+
+    last_task = status['last_task']
+    if last_task is not None:
+        print("Last task:\t{0}\t{1}{2}".format(last_task['id'], last_task['label'],
+              "" if last_task['project'] is None else " ({0})".format(last_task['project'])))
+
+
+def get_db_file_state(db_file_path):
+    """
+    Returns the modification times and sizes of a DB file and its write-ahead log, which change
+    whenever anything is written to it.  A missing or empty log counts the same, as SQLite
+    leaves either behind once everything has been checkpointed.
+    """
+    state = list()
+
+    for file_path in (db_file_path, db_file_path + '-wal'):
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            file_stat = None
+
+        if file_stat is None or file_stat.st_size == 0:
+            state.append(None)
         else:
-            curs.execute("INSERT INTO task (label, time_added, project_id) VALUES (?, ?, ?)",
-                         (args[0], args[2], project_id) )
-            print("Qtask: task id:{0} logged to project {1} on {2}".format(curs.lastrowid, project_label, args[2]))
+            state.append([file_stat.st_mtime_ns, file_stat.st_size])
+
+    return state
+
 
+def write_status_file(db_file_path, status):
+    """
+    Saves a status summary next to the DB for 'qtask status --fast', along with the state of the
+    DB files it was read from.  It's written to a temporary file which is then renamed into
+    place, so a reader never sees half of one.
+
+    The file is plain text with one tab-separated record per line, so shell prompts can read it
+    with cut or read as well, and writing it (after every write to the DB) needs no imports:
+
+        date        <YYYY-MM-DD>
+        db_state    <DB mtime_ns> <DB size> <log mtime_ns> <log size>
+        today       <minutes> <tasks>
+        week        <start date> <minutes>
+        project     <minutes> <tasks> <label>     (one per project logged to this week)
+        last_task   <id> <minutes logged> <project> <label>
+
+    Missing values are left empty, and tabs, newlines and backslashes in labels are escaped
+    as \\t, \\n and \\\\.
+    """
+    status_path = get_status_file_path(db_file_path)
+    temp_path = "{0}.{1}.tmp".format(status_path, os.getpid())
+
+    records = [['date', status['date']],
+               ['db_state'] + [value for file_state in get_db_file_state(db_file_path) for value in (file_state or ['', ''])],
+               ['today', status['today']['minutes'], status['today']['tasks']],
+               ['week', status['week']['start'], status['week']['minutes']]]
+
+    for project in status['week']['projects']:
+        records.append(['project', project['minutes'], project['tasks'], project['label']])
+
+    last_task = status['last_task']
+    if last_task is not None:
+        records.append(['last_task', last_task['id'], last_task['time_logged'], last_task['project'], last_task['label']])
+
+    try:
+        with open(temp_path, 'w') as fh:
+            for record in records:
+                fh.write('\t'.join([escape_status_value(value) for value in record]) + '\n')
+        os.replace(temp_path, status_path)
+    except OSError as e:
+        print("Qtask: WARNING: couldn't save the status summary {0}: {1}".format(status_path, e), file=sys.stderr)
+
+
+def escape_status_value(value):
+    if value is None:
+        return ''
+
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def unescape_status_value(value):
+    return '\\'.join([part.replace('\\t', '\t').replace('\\n', '\n') for part in value.split('\\\\')])
+
+
+def parse_status_number(value):
+    if value == '':
+        return None
+
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def read_status_file(db_file_path):
+    """
+    Returns the saved status summary for a DB, or None if there isn't one or it's out of date,
+    either because it's from a previous day or because the DB has been written since.
+    """
+    status = {'date': None, 'today': None, 'week': {'start': None, 'minutes': None, 'projects': list()}, 'last_task': None}
+    db_state = None
+
+    try:
+        with open(get_status_file_path(db_file_path)) as fh:
+            for line in fh:
+                record = [unescape_status_value(value) for value in line.rstrip('\n').split('\t')]
+
+                if record[0] == 'date':
+                    status['date'] = record[1]
+                elif record[0] == 'db_state':
+                    values = [parse_status_number(value) for value in record[1:5]]
+                    db_state = [values[0:2] if values[0] is not None else None,
+                                values[2:4] if values[2] is not None else None]
+                elif record[0] == 'today':
+                    status['today'] = {'minutes': parse_status_number(record[1]), 'tasks': parse_status_number(record[2])}
+                elif record[0] == 'week':
+                    status['week'].update(start=record[1], minutes=parse_status_number(record[2]))
+                elif record[0] == 'project':
+                    status['week']['projects'].append({'label': record[3], 'tasks': parse_status_number(record[2]),
+                                                       'minutes': parse_status_number(record[1])})
+                elif record[0] == 'last_task':
+                    status['last_task'] = {'id': parse_status_number(record[1]), 'label': record[4],
+                                           'project': record[3] or None, 'time_logged': parse_status_number(record[2])}
+    except (OSError, ValueError, IndexError):
+        return None
+
+    # anything else, such as a summary saved in an older format, is worked out again
+    if status['date'] != str(datetime.date.today()) or status['today'] is None or status['week']['start'] is None:
+        return None
+
+    if db_state != get_db_file_state(db_file_path):
+        return None
+
+    return status
+
+
+def rebuild_rollups(curs):
+    curs.execute("DELETE FROM daily_project_totals")
+    curs.execute('''INSERT INTO daily_project_totals (day, project_id, task_count, minutes)
+                        SELECT time_added_epoch / 86400, COALESCE(project_id, 0), COUNT(*), SUM(COALESCE(time_logged, 0))
+                          FROM task
+                         WHERE time_added_epoch IS NOT NULL
+                      GROUP BY 1, 2''')
+
+    # archived work still counts towards the totals.  Each archive is read on a connection of its
+    # own so there's no limit on how many years there are.
+    db_file_path = get_connected_db_path(curs)
+
+    for year in get_archive_years(curs):
+        archive_conn = sqlite3.connect(get_archive_path(db_file_path, year))
+        totals = archive_conn.execute('''SELECT time_added_epoch / 86400, COALESCE(project_id, 0), COUNT(*), SUM(COALESCE(time_logged, 0))
+                                            FROM task
+                                           WHERE time_added_epoch IS NOT NULL
+                                        GROUP BY 1, 2''').fetchall()
+        archive_conn.close()
+        add_rollup_totals(curs, totals)
+
+
+def add_rollup_totals(curs, totals):
+    """
+    Adds (day, project_id, task_count, minutes) rows onto the daily_project_totals rollups
+    """
+    curs.executemany('''INSERT INTO daily_project_totals (day, project_id, task_count, minutes) VALUES (?, ?, ?, ?)
+                        ON CONFLICT (day, project_id) DO UPDATE
+                             SET task_count = task_count + excluded.task_count, minutes = minutes + excluded.minutes''', totals)
+
+
+def serve_db(file_path, timeout=DEFAULT_BUSY_TIMEOUT):
+    """
+    Runs the 'qtask serve' daemon: one long-lived connection (so a warm page cache and prepared
+    statement cache) answering commands from qtask clients on a Unix domain socket next to the
+    DB file.  Commands are handled one at a time, each committed (or rolled back) on its own.
+    """
+    import signal
+    import socket
+
+    socket_path = get_daemon_socket_path(file_path)
+    store = TaskStore.open(file_path, timeout=timeout, cached_statements=DAEMON_STATEMENT_CACHE_SIZE)
+    store.conn.execute("PRAGMA cache_size = -{0:d}".format(DAEMON_CACHE_KIB))
+    parser = build_arg_parser()
+
+    # refuse to start if another daemon is answering, but clean up after one which died
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+            print_error("Qtask: ERROR: a qtask daemon is already serving {0} on {1}".format(file_path, socket_path))
+        except ConnectionRefusedError:
+            os.unlink(socket_path)
+        finally:
+            probe.close()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+
+    server.listen(DAEMON_LISTEN_BACKLOG)
+
+    # shut down cleanly (removing the socket) on 'kill' as well as Ctrl-C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    print("Qtask: serving {0} on {1}".format(file_path, socket_path))
+    sys.stdout.flush()
+
+    try:
+        while True:
+            (client, address) = server.accept()
+            try:
+                serve_daemon_request(store, parser, client)
+            except OSError:
+                # the client went away mid-request; nothing to report back to
+                store.rollback()
+            finally:
+                client.close()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(socket_path)
+        store.close()
+
+
+def serve_daemon_request(store, parser, client):
+    import contextlib
+    import json
+    import traceback
+
+    reader = client.makefile('rb')
+    header = reader.read(DAEMON_FRAME_HEADER.size)
+    if len(header) < DAEMON_FRAME_HEADER.size:
+        return
+
+    (frame_type, length) = DAEMON_FRAME_HEADER.unpack(header)
+    request = json.loads(reader.read(length).decode('utf-8'))
+
+    stdout = DaemonOutputStream(client, b'o')
+    stderr = DaemonOutputStream(client, b'e')
+    status = 0
+    changes_before = store.conn.total_changes
+
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        try:
+            os.chdir(request['cwd'])
+            args = parser.parse_args(request['argv'])
+
+            # The client only looks at the command line briefly, so it may have sent a command
+            # meant for another DB.  Those are handed back to it to run directly.
+            if not is_daemon_db(store.curs, args.db_file):
+                client.sendall(DAEMON_FRAME_HEADER.pack(b'd', 0))
+                return
+
+            run_command_with_retry(store, args)
+
+            # keep the summary for 'qtask status --fast' current, as main() does
+            if store.conn.total_changes != changes_before:
+                write_status_file(get_connected_db_path(store.curs), get_status(store.curs))
+        except QtaskError as e:
+            print(e)
+            status = 1
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                status = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+
+    stdout.flush()
+    stderr.flush()
+    payload = str(status).encode('utf-8')
+    client.sendall(DAEMON_FRAME_HEADER.pack(b'x', len(payload)) + payload)
+
+
+def is_daemon_db(curs, db_files):
+    """
+    Checks that the --db_file values of a command sent to the daemon name the one DB it serves
+    """
+    db_file_paths = get_db_file_paths(db_files)
+    if len(db_file_paths) != 1:
+        return False
+
+    return os.path.realpath(db_file_paths[0]) == os.path.realpath(get_connected_db_path(curs))
+
+
+class DaemonOutputStream(object):
+    """
+    File-like stand-in for stdout/stderr inside the daemon which sends everything written to it
+    back to the client as framed messages.
+    """
+    def __init__(self, sock, frame_type):
+        self.sock = sock
+        self.frame_type = frame_type
+        self.buffer = list()
+        self.buffer_size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffer_size += len(text)
+        if self.buffer_size >= DAEMON_OUTPUT_BUFFER_SIZE:
+            self.flush()
+        return len(text)
+
+    def flush(self):
+        if self.buffer:
+            payload = ''.join(self.buffer).encode('utf-8')
+            self.buffer = list()
+            self.buffer_size = 0
+            self.sock.sendall(DAEMON_FRAME_HEADER.pack(self.frame_type, len(payload)) + payload)
+
+
+def write_rows(curs, columns, output_format):
+    """
+    Streams the rows of an executed query (or any other iterator of rows) to STDOUT as tsv, csv
+    or jsonl, a batch at a time, without any of the formatting done for people reading the
+    output.  Returns the number of rows written and the last of them.
+    """
+    if output_format == 'jsonl':
+        import json
+        write_batch = lambda rows: sys.stdout.write(''.join([json.dumps(dict(zip(columns, row))) + '\n' for row in rows]))
     else:
-        print_error("Qtask: I didn't understand your log command.  See 'qtask help log' for examples")
+        import csv
+        delimiter = '\t' if output_format == 'tsv' else ','
+        writer = csv.writer(sys.stdout, delimiter=delimiter, lineterminator='\n')
+        writer.writerow(columns)
+        write_batch = writer.writerows
+
+    if hasattr(curs, 'fetchmany'):
+        fetch_batch = curs.fetchmany
+    else:
+        fetch_batch = lambda size: list(itertools.islice(curs, size))
+
+    row_count = 0
+    last_row = None
+
+    while True:
+        rows = fetch_batch(REPORT_FETCH_SIZE)
+        if not rows:
+            break
+
+        write_batch(rows)
+        row_count += len(rows)
+        last_row = rows[-1]
+
+    return (row_count, last_row)
+
+
+class CommandProfile(object):
+    """
+    Collects the timings printed by --profile: each phase of main() and, through
+    ProfilingConnection, every SQL statement run.  Only created when profiling is on.
+    """
+    def __init__(self, main_started, dump_file=None):
+        # there's no portable clock for when the process began, but the CPU time used so far
+        # covers interpreter startup and imports
+        self.startup_cpu = time.process_time()
+        self.main_started = main_started
+        self.last_mark = main_started
+        self.phases = list()
+        self.dump_file = dump_file
+        self.profiler = None
+        self.command_started = None
+        self.command_first_record = 0
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last_mark))
+        self.last_mark = now
+
+    def start_command(self, conn):
+        self.command_started = time.perf_counter()
+        self.command_first_record = len(conn.profile_records)
+        if self.dump_file is not None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def finish(self, conn):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.dump_file)
+
+        records = list()
+        if isinstance(conn, ProfilingConnection):
+            records = conn.profile_records
+
+        if self.command_started is not None:
+            self.mark('run command')
+
+        sql_time = sum([record['time'] for record in records[self.command_first_record:]])
+        total = time.perf_counter() - self.main_started
+
+        out = sys.stderr
+        out.write("\n# qtask profile\n# -------------\n")
+        out.write("{0:<42}{1:10.2f} ms\n".format('startup (interpreter + imports, CPU time)', self.startup_cpu * 1000))
+        for (phase, elapsed) in self.phases:
+            out.write("{0:<42}{1:10.2f} ms\n".format(phase, elapsed * 1000))
+            if phase == 'run command':
+                out.write("{0:<42}{1:10.2f} ms\n".format('  of which SQL', sql_time * 1000))
+                out.write("{0:<42}{1:10.2f} ms\n".format('  of which Python (parsing, formatting)', (elapsed - sql_time) * 1000))
+        out.write("{0:<42}{1:10.2f} ms\n".format('total in main()', total * 1000))
+
+        if records:
+            out.write("\n# SQL statements (time includes fetching rows)\n")
+
+        for (i, record) in enumerate(records, start=1):
+            sql = ' '.join(record['sql'].split())
+            out.write("[{0}] {1:.2f} ms, {2} rows: {3}\n".format(i, record['time'] * 1000, record['rows'], sql))
+
+            for line in get_query_plan(conn, record['sql'], record['params']):
+                out.write("      plan: {0}\n".format(line))
+
+        if self.profiler is not None:
+            out.write("\ncProfile stats written to {0}\n".format(self.dump_file))
+
+
+def get_query_plan(conn, sql, params):
+    # only statements which read or write tables have a plan worth showing
+    if sql.split(None, 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'REPLACE'):
+        return []
+
+    try:
+        curs = conn.cursor(sqlite3.Cursor)
+        curs.execute("EXPLAIN QUERY PLAN " + sql, params)
+        return [row[3] for row in curs.fetchall()]
+    except sqlite3.Error as e:
+        return ["(unavailable: {0})".format(e)]
+
+
+class ProfilingConnection(sqlite3.Connection):
+    """
+    Connection whose cursors record the SQL they run, with timings and row counts, for --profile
+    """
+    def __init__(self, *args, **kwargs):
+        sqlite3.Connection.__init__(self, *args, **kwargs)
+        self.profile_records = list()
+
+    def cursor(self, factory=None):
+        return sqlite3.Connection.cursor(self, factory or ProfilingCursor)
+
+    def commit(self):
+        started = time.perf_counter()
+        sqlite3.Connection.commit(self)
+        self.profile_records.append({'sql': 'COMMIT', 'params': (), 'time': time.perf_counter() - started, 'rows': 0})
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return self.timed_execute(sqlite3.Cursor.execute, sql, parameters, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        first_parameters = seq_of_parameters[0] if seq_of_parameters else ()
+        return self.timed_execute(sqlite3.Cursor.executemany, sql, seq_of_parameters, first_parameters)
+
+    def timed_execute(self, method, sql, parameters, plan_parameters):
+        self.record = {'sql': sql, 'params': plan_parameters, 'time': 0.0, 'rows': 0}
+        self.connection.profile_records.append(self.record)
+
+        started = time.perf_counter()
+        try:
+            return method(self, sql, parameters)
+        finally:
+            self.record['time'] += time.perf_counter() - started
+            if self.rowcount > 0:
+                self.record['rows'] = self.rowcount
+
+    def timed_fetch(self, method, *args):
+        started = time.perf_counter()
+        result = method(self, *args)
+        self.record['time'] += time.perf_counter() - started
+        return result
+
+    def fetchone(self):
+        row = self.timed_fetch(sqlite3.Cursor.fetchone)
+        if row is not None:
+            self.record['rows'] += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.timed_fetch(sqlite3.Cursor.fetchmany, self.arraysize if size is None else size)
+        self.record['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.timed_fetch(sqlite3.Cursor.fetchall)
+        self.record['rows'] += len(rows)
+        return rows
+
+    def __next__(self):
+        row = self.timed_fetch(sqlite3.Cursor.__next__)
+        self.record['rows'] += 1
+        return row
+
 
 def time_logged_string(minutes):
     if minutes is None:
@@ -531,8 +3782,22 @@ def get_delta(quant, unit):
 
     return delta
 
+def run_cli():
+    """
+    Entry point of the 'qtask' launcher script (and of running qtask.py directly)
+    """
+    try:
+        main()
+    except BrokenPipeError:
+        # Whatever was reading our output (e.g. 'head') has gone away.  Point STDOUT at
+        # /dev/null so Python's own flush at exit doesn't fail again and print a traceback.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+
+
 if __name__ == '__main__':
-    main()
+    run_cli()
 
 
 
@@ -0,0 +1,450 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks qtask against generated databases of different sizes.
+
+Databases are built directly through the schema from qtask's own initialize_db(), filled
+with synthetic projects and tasks, then the real 'qtask' entry point is timed against them
+as separate processes, exactly as a user would call it.  Example usage:
+
+  ./qtask_bench.py
+  ./qtask_bench.py --sizes 10000 1000000 --json results.json
+  ./qtask_bench.py --sizes 10000 --compare results.json
+
+Generated databases are kept in --db_dir and reused by later runs.  Results can be written
+as JSON and compared against an earlier run, in which case any case that got slower by more
+than --threshold is reported and the exit status is 1.
+
+Startup is also checked with 'python -X importtime': the everyday commands must stay within
+--import_budget milliseconds of imports and must not import any of STARTUP_LAZY_MODULES,
+or the exit status is 1.  The query plans (EXPLAIN QUERY PLAN, as shown by --profile) of
+the project lookups and per-project listings must also use the indexes meant for them.
+
+Finally several processes log time against one task at once, some as separate 'qtask log'
+calls and some through 'qtask batch', and every minute must end up counted.  Set
+--stress_processes 0 to skip this.
+
+WARNING: generating the 10M task database takes several minutes and a few GB of disk.
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import itertools
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+
+import qtask
+
+QTASK_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qtask')
+
+# qtask is timed as users run it, which includes loading it from cached bytecode
+QTASK_ENV = dict((key, value) for (key, value) in os.environ.items() if key != 'PYTHONDONTWRITEBYTECODE')
+
+# modules which log and list must not import at startup; qtask only loads them where they're needed
+STARTUP_LAZY_MODULES = ['argparse', 'calendar', 'concurrent.futures', 'csv', 'glob', 'json', 'random',
+                        'shlex', 'signal', 'socket', 'traceback']
+
+# default limit on the milliseconds log and list may spend importing qtask and what it imports
+STARTUP_IMPORT_BUDGET_MS = 25.0
+
+# commands checked with --profile, and the indexes their query plans must use.  {project} is
+# replaced by a project label from the generated DB.
+QUERY_PLAN_CASES = [
+    ('log to <project>', ['log', 'Query plan check task', 'to', '{project}'], ['idx_project_label']),
+    ('list <project> work in last 52 weeks', ['list', '{project}', 'work', 'in', 'last', '52', 'weeks'],
+     ['idx_project_label', 'idx_task_project_time_added_epoch']),
+]
+
+# defaults for the concurrent logging test: processes logging at once, and minutes each one logs
+STRESS_PROCESSES = 8
+STRESS_INCREMENTS = 20
+
+# tasks are generated in batches of this many rows per executemany() call
+GENERATE_BATCH_SIZE = 50000
+
+# history covered by the generated tasks.  Task ages are exponentially distributed, so most
+# of the work is recent, as in a real log.
+HISTORY_DAYS = 10 * 365
+MEAN_TASK_AGE_DAYS = 180
+
+# words used to build random task labels
+LABEL_WORDS = ['annotation', 'assembly', 'BLAST', 'bowtie2', 'call', 'conference', 'genome', 'index',
+               'JBrowse', 'meeting', 'pipeline', 'review', 'RNA-seq', 'script', 'status', 'timesheets',
+               'transcript', 'update', 'variant', 'workflow']
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Time qtask commands against generated databases')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000], help='Task counts of the DBs to test (e.g. 10000 1000000 10000000)' )
+    parser.add_argument('--projects', type=int, default=300, help='Number of projects per generated DB' )
+    parser.add_argument('--db_dir', type=str, default='bench_dbs', help='Directory where generated DBs are kept' )
+    parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs per case' )
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for data generation' )
+    parser.add_argument('--json', type=str, required=False, help='Write the results to this JSON file' )
+    parser.add_argument('--compare', type=str, required=False, help='Earlier JSON results to check for regressions' )
+    parser.add_argument('--threshold', type=float, default=1.25, help='Slowdown ratio counted as a regression' )
+    parser.add_argument('--import_budget', type=float, default=STARTUP_IMPORT_BUDGET_MS,
+                        help='Milliseconds log and list may spend on imports at startup' )
+    parser.add_argument('--stress_processes', type=int, default=STRESS_PROCESSES,
+                        help='Processes logging time to one task at once in the lost increment test (0 to skip)' )
+    parser.add_argument('--stress_increments', type=int, default=STRESS_INCREMENTS,
+                        help='Times each process logs a minute in the lost increment test' )
+    args = parser.parse_args()
+
+    os.makedirs(args.db_dir, exist_ok=True)
+
+    results = {
+        'time': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'repeat': args.repeat,
+        'sizes': dict(),
+    }
+
+    results['startup'] = time_startup(args.repeat)
+    print_results('startup', results['startup'])
+    startup_problems = list()
+    plan_problems = list()
+    stress_problems = list()
+
+    for size in args.sizes:
+        db_path = os.path.join(args.db_dir, "bench_{0}_{1}.db".format(size, args.projects))
+
+        if not os.path.exists(db_path):
+            print("Generating {0} ({1} tasks in {2} projects)".format(db_path, size, args.projects))
+            started = time.perf_counter()
+            generate_db(db_path, size, args.projects, args.seed)
+            print("  done in {0:.1f} seconds".format(time.perf_counter() - started))
+
+        results['sizes'][str(size)] = time_commands(db_path, args.repeat)
+        print_results("{0} tasks".format(size), results['sizes'][str(size)])
+
+        if size == args.sizes[0]:
+            (results['imports'], startup_problems) = check_startup_imports(db_path, args.import_budget)
+            print_import_results(results['imports'])
+
+            (results['query_plans'], plan_problems) = check_query_plans(db_path)
+            print_query_plan_results(results['query_plans'])
+
+    if args.stress_processes > 0:
+        (results['stress'], stress_problems) = check_concurrent_increments(args.db_dir, args.stress_processes, args.stress_increments)
+        print_stress_results(results['stress'])
+
+    if args.json is not None:
+        with open(args.json, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+        print("\nResults written to {0}".format(args.json))
+
+    if args.compare is not None:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+
+        regressions = find_regressions(baseline, results, args.threshold)
+
+        if regressions:
+            print("\nRegressions (more than {0:.0f}% slower than {1}):".format((args.threshold - 1) * 100, args.compare))
+            for (name, old_time, new_time) in regressions:
+                print("  {0}: {1:.1f} ms -> {2:.1f} ms".format(name, old_time * 1000, new_time * 1000))
+            sys.exit(1)
+        else:
+            print("\nNo regressions compared to {0}".format(args.compare))
+
+    checks = [('Startup problems', startup_problems), ('Query plan problems', plan_problems),
+              ('Concurrent logging problems', stress_problems)]
+
+    for (title, problems) in checks:
+        if problems:
+            print("\n{0}:".format(title))
+            for problem in problems:
+                print("  {0}".format(problem))
+
+    if startup_problems or plan_problems or stress_problems:
+        sys.exit(1)
+
+
+def check_startup_imports(db_path, budget_ms):
+    """
+    Runs the everyday commands under 'python -X importtime' and returns the milliseconds each
+    spent importing qtask and everything loaded after it, plus a list of problems: commands
+    over the budget or importing any of STARTUP_LAZY_MODULES.
+    """
+    cases = [
+        ('log', ['log', 'Startup check task']),
+        ('list work today', ['list', 'work', 'today']),
+    ]
+    import_times = dict()
+    problems = list()
+
+    for (name, arglist) in cases:
+        cmd = [sys.executable, '-X', 'importtime', QTASK_PATH, '-d', db_path] + arglist
+
+        # the first run writes qtask's cached bytecode, so only the second is measured
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=QTASK_ENV, check=True)
+        stderr = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=QTASK_ENV,
+                                check=True, universal_newlines=True).stderr
+
+        # lines look like 'import time:  self [us] | cumulative | imported package', indented by depth
+        modules = list()
+        top_level = list()
+        for line in stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+
+            (self_us, cumulative_us, module) = line[len('import time:'):].split('|')
+            modules.append(module.strip())
+            if not module[1:].startswith(' '):
+                top_level.append((module.strip(), int(cumulative_us)))
+
+        # everything from qtask on is down to qtask; what comes before is the interpreter's own startup
+        names = [module for (module, cumulative_us) in top_level]
+        first = names.index('qtask') if 'qtask' in names else len(top_level)
+        import_times[name] = sum([cumulative_us for (module, cumulative_us) in top_level[first:]]) / 1000
+
+        if import_times[name] > budget_ms:
+            problems.append("{0}: {1:.1f} ms of imports is over the {2:.1f} ms budget".format(name, import_times[name], budget_ms))
+
+        lazy_imported = sorted(set(modules) & set(STARTUP_LAZY_MODULES))
+        if lazy_imported:
+            problems.append("{0}: imports {1}, which should only be loaded when needed".format(name, ', '.join(lazy_imported)))
+
+    return (import_times, problems)
+
+
+def print_import_results(import_times):
+    title = 'startup imports'
+    print("\n{0}\n{1}".format(title, '-' * len(title)))
+
+    for (case, import_ms) in import_times.items():
+        print("  {0:<45} {1:8.1f} ms".format(case, import_ms))
+
+
+def check_query_plans(db_path):
+    """
+    Runs each of QUERY_PLAN_CASES with --profile and returns the indexes its query plans used,
+    plus a list of problems: any index the case needs which none of its plans used.
+    """
+    conn = sqlite3.connect(db_path)
+    (project_label,) = conn.execute("SELECT label FROM project ORDER BY id LIMIT 1").fetchone()
+    conn.close()
+
+    indexes_used = dict()
+    problems = list()
+
+    for (name, arglist, needed_indexes) in QUERY_PLAN_CASES:
+        arglist = [arg.format(project=project_label) for arg in arglist]
+        stderr = subprocess.run([sys.executable, QTASK_PATH, '-d', db_path, '--profile'] + arglist, stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, env=QTASK_ENV, check=True, universal_newlines=True).stderr
+
+        # plan lines look like 'plan: SEARCH t USING INDEX idx_name (project_id=? AND ...)'
+        used = set()
+        for line in stderr.splitlines():
+            words = line.split()
+            if words[:1] == ['plan:'] and 'INDEX' in words[:-1]:
+                used.add(words[words.index('INDEX') + 1])
+
+        indexes_used[name] = sorted(used)
+
+        for index_name in needed_indexes:
+            if index_name not in used:
+                problems.append("{0}: no query plan used {1} (used: {2})".format(name, index_name, ', '.join(sorted(used)) or 'none'))
+
+    return (indexes_used, problems)
+
+
+def print_query_plan_results(indexes_used):
+    title = 'query plan indexes'
+    print("\n{0}\n{1}".format(title, '-' * len(title)))
+
+    for (case, index_names) in indexes_used.items():
+        print("  {0:<45} {1}".format(case, ', '.join(index_names)))
+
+
+def check_concurrent_increments(db_dir, process_count, increment_count):
+    """
+    Has process_count processes each log one minute against the same task increment_count
+    times, all at once: half by running 'qtask log 1 minutes against task 1' each time and half
+    through one 'qtask batch' session each, committing after every line.  Returns the time it
+    took and the minutes counted, plus a list of problems: commands which failed and any
+    minutes missing from the task, its per-machine time or the daily totals.
+    """
+    db_path = os.path.join(db_dir, 'stress.db')
+    for suffix in ('', '-wal', '-shm', qtask.STATUS_FILE_SUFFIX):
+        if os.path.exists(db_path + suffix):
+            os.unlink(db_path + suffix)
+
+    qtask_cmd = [sys.executable, QTASK_PATH, '-d', db_path]
+    subprocess.run(qtask_cmd + ['init'], stdout=subprocess.DEVNULL, env=QTASK_ENV, check=True)
+    subprocess.run(qtask_cmd + ['log', 'Concurrent logging test task'], stdout=subprocess.DEVNULL, env=QTASK_ENV, check=True)
+
+    def run_worker(worker):
+        failures = list()
+
+        if worker % 2 == 0:
+            for i in range(increment_count):
+                completed = subprocess.run(qtask_cmd + ['log', '1', 'minutes', 'against', 'task', '1'], stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT, env=QTASK_ENV, universal_newlines=True)
+                if completed.returncode != 0:
+                    failures.append("log process {0} failed: {1}".format(worker, completed.stdout.strip()))
+        else:
+            completed = subprocess.run(qtask_cmd + ['--commit_interval', '1', 'batch', '-'], input="log 1 minutes against task 1\n" * increment_count,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=QTASK_ENV, universal_newlines=True)
+            if completed.returncode != 0:
+                failures.append("batch process {0} failed: {1}".format(worker, completed.stdout.strip()))
+
+        return failures
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=process_count) as executor:
+        problems = list(itertools.chain.from_iterable(executor.map(run_worker, range(process_count))))
+    elapsed = time.perf_counter() - started
+
+    conn = sqlite3.connect(db_path)
+    counted = {
+        'task': conn.execute("SELECT time_logged FROM task WHERE id = 1").fetchone()[0],
+        'task_time': conn.execute("SELECT SUM(minutes) FROM task_time WHERE task_id = 1").fetchone()[0],
+        'daily totals': conn.execute("SELECT SUM(minutes) FROM daily_project_totals").fetchone()[0],
+    }
+    conn.close()
+
+    expected = process_count * increment_count
+    for (name, minutes) in counted.items():
+        if minutes != expected:
+            problems.append("{0} minutes logged, but {1} counted {2}".format(expected, name, minutes))
+
+    return ({'processes': process_count, 'minutes': expected, 'seconds': elapsed, 'counted': counted}, problems)
+
+
+def print_stress_results(stress):
+    title = 'concurrent logging'
+    print("\n{0}\n{1}".format(title, '-' * len(title)))
+    print("  {0} processes logged {1} minutes in {2:.1f} seconds".format(stress['processes'], stress['minutes'], stress['seconds']))
+
+    for (name, minutes) in stress['counted'].items():
+        print("  {0:<45} {1} minutes".format("counted in " + name, minutes))
+
+
+def find_regressions(baseline, results, threshold):
+    """
+    Returns (case name, old median, new median) for every case present in both runs whose
+    median time grew by more than the threshold ratio.
+    """
+    regressions = list()
+    pairs = [('startup', baseline.get('startup', dict()), results['startup'])]
+
+    for (size, cases) in results['sizes'].items():
+        pairs.append(("{0} tasks".format(size), baseline.get('sizes', dict()).get(size, dict()), cases))
+
+    for (group, old_cases, new_cases) in pairs:
+        for (case, timing) in new_cases.items():
+            if case in old_cases and timing['median'] > old_cases[case]['median'] * threshold:
+                regressions.append(("{0}: {1}".format(group, case), old_cases[case]['median'], timing['median']))
+
+    return regressions
+
+
+def generate_db(db_path, task_count, project_count, seed):
+    rng = random.Random(seed)
+    qtask.initialize_db(db_path)
+
+    conn = sqlite3.connect(db_path)
+    curs = conn.cursor()
+    curs.execute("PRAGMA synchronous = OFF")
+
+    now = datetime.datetime.now().replace(microsecond=0)
+    project_ids = list()
+
+    for i in range(project_count):
+        curs.execute("INSERT INTO project (label, time_added) VALUES (?, ?)",
+                     ("project_{0:04d}".format(i), str(now - datetime.timedelta(days=HISTORY_DAYS))))
+        project_ids.append(curs.lastrowid)
+
+    # a few projects get most of the work
+    project_weights = [1.0 / (rank + 1) for rank in range(project_count)]
+
+    remaining = task_count
+    while remaining > 0:
+        batch_size = min(remaining, GENERATE_BATCH_SIZE)
+        projects = rng.choices(project_ids, weights=project_weights, k=batch_size)
+        rows = list()
+
+        for project_id in projects:
+            age = min(rng.expovariate(1.0 / MEAN_TASK_AGE_DAYS), HISTORY_DAYS)
+            time_added = now - datetime.timedelta(days=age)
+            label = ' '.join(rng.sample(LABEL_WORDS, rng.randint(2, 5)))
+            time_logged = rng.choice([None, None, 15, 30, 60, 120, 240])
+
+            # about one task in ten isn't filed under any project
+            if rng.random() < 0.1:
+                project_id = None
+
+            rows.append((label, str(time_added), qtask.get_epoch(time_added), time_logged, project_id))
+
+        curs.executemany("INSERT INTO task (label, time_added, time_added_epoch, time_logged, project_id) VALUES (?, ?, ?, ?, ?)", rows)
+        conn.commit()
+        remaining -= batch_size
+
+    curs.execute("ANALYZE")
+    conn.commit()
+    conn.close()
+
+
+def print_results(title, cases):
+    print("\n{0}\n{1}".format(title, '-' * len(title)))
+
+    for (case, timing) in cases.items():
+        print("  {0:<45} median {1:8.1f} ms   min {2:8.1f} ms".format(case, timing['median'] * 1000, timing['min'] * 1000))
+
+
+def time_commands(db_path, repeat):
+    conn = sqlite3.connect(db_path)
+    (task_id,) = conn.execute("SELECT MAX(id) FROM task").fetchone()
+    (project_label,) = conn.execute("SELECT label FROM project ORDER BY id LIMIT 1").fetchone()
+    conn.close()
+
+    cases = [
+        ('log', ['log', 'Benchmark task']),
+        ('log against task', ['log', '30', 'minutes', 'against', 'task', str(task_id)]),
+        ('list work today', ['list', 'work', 'today']),
+        ('list <project> work in last 2 weeks', ['list', project_label, 'work', 'in', 'last', '2', 'weeks']),
+        ('list <project> work in last 52 weeks', ['list', project_label, 'work', 'in', 'last', '52', 'weeks']),
+        ('report work in last 4 weeks', ['report', 'work', 'in', 'last', '4', 'weeks']),
+        ('report work', ['report', 'work']),
+        ('report totals by week in last 52 weeks', ['report', 'totals', 'by', 'week', 'in', 'last', '52', 'weeks']),
+        ('search', ['search', 'genome index']),
+    ]
+
+    timings = dict()
+    for (name, arglist) in cases:
+        timings[name] = time_process([sys.executable, QTASK_PATH, '-d', db_path] + arglist, repeat)
+
+    return timings
+
+
+def time_process(cmd, repeat):
+    elapsed = list()
+
+    for i in range(repeat):
+        started = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, env=QTASK_ENV, check=True)
+        elapsed.append(time.perf_counter() - started)
+
+    return {'median': statistics.median(elapsed), 'min': min(elapsed)}
+
+
+def time_startup(repeat):
+    return {
+        'python -c pass': time_process([sys.executable, '-c', 'pass'], repeat),
+        'qtask help': time_process([sys.executable, QTASK_PATH, 'help'], repeat),
+    }
+
+
+if __name__ == '__main__':
+    main()